@@ -0,0 +1,131 @@
+import os
+import sys
+import timeit
+import argparse
+
+from dist.arch import ArchInstaller
+from dist.gentoo import GentooInstaller
+
+GENTOO_CONFIG = 'builds/vmware/gentoo/vmware_lvm.cfg'
+ARCH_CONFIG = 'builds/vmware/arch/vmware_lvm_i3.cfg'
+
+COUNTRIES = ['United States', 'Canada', 'Germany', 'France', 'Japan', 'Brazil', 'Sweden', 'Australia']
+
+
+def get_blkid_output(n):
+    lines = []
+    for i in range(n):
+        lines.append('/dev/sd%s%d: UUID="%08x-1f2e-4d3c-8b9a-%012x" BLOCK_SIZE="4096" TYPE="ext4" '
+                     'LABEL="vol%d" PARTUUID="%08x-%02d"' % (chr(97 + i % 26), i % 16, i, i, i, i, i % 16))
+    return '\n'.join(lines)
+
+
+def get_emerge_output(n):
+
+    '''Output of an emerge needing USE, keyword and license changes after n lines of noise'''
+
+    lines = ['>>> Emerging (%d of %d) dev-libs/libfoo%d-1.%d.0::gentoo' % (i, n, i, i) for i in range(n)]
+    lines += ['',
+              'The following USE changes are necessary to proceed:',
+              ' (see "package.use" in the portage(5) man page for more details)',
+              '# required by media-libs/mesa-21.1.0::gentoo[vaapi]',
+              '# required by x11-base/xorg-server-1.20.11::gentoo',
+              '# required by x11-base/xorg-server (argument)',
+              '>=x11-libs/libdrm-2.4.105 video_cards_radeon video_cards_amdgpu',
+              '']
+    for i in range(n // 10):
+        lines += ['The following keyword changes are necessary to proceed:',
+                  '# required by app-misc/tool%d (argument)' % (i),
+                  '=app-misc/tool%d-0.%d ~amd64' % (i, i),
+                  '']
+    lines += ['The following license changes are necessary to proceed:',
+              '>=sys-kernel/linux-firmware-20210511 linux-fw-redistributable no-source-code',
+              '']
+    return '\n'.join(lines)
+
+
+def get_xorg_conf(n):
+    lines = []
+    for i in range(n):
+        lines += ['Section "InputClass"',
+                  '    Identifier "device%d"' % (i),
+                  '    MatchIsPointer "on"',
+                  '    Option "AccelProfile" "flat"',
+                  '    SubSection "Display"',
+                  '        Depth 24',
+                  '        Modes "1920x1080" "1280x720"',
+                  '    EndSubSection',
+                  'EndSection',
+                  '']
+    return [line + '\n' for line in lines]
+
+
+def get_flags(n, offset=0):
+    return 'USE="%s"' % (' '.join(['flag%d' % (i) for i in range(offset, offset + n)]))
+
+
+def get_mirrorlist(n):
+    lines = ['##\n', '## Arch Linux repository mirrorlist\n', '##\n', '\n']
+    for i in range(n):
+        lines += ['## %s\n' % (COUNTRIES[i % len(COUNTRIES)]),
+                  'Server = https://mirror%d.example%d.org/archlinux/$repo/os/$arch\n' % (i, i % 50),
+                  '\n']
+    return lines
+
+
+def get_benchmarks(gentoo, arch, scale):
+
+    '''Get the (name, input size, callable) of every benchmark'''
+
+    blkid = get_blkid_output(200 * scale)
+    emerge = get_emerge_output(500 * scale)
+    emerge_lines = emerge.splitlines()
+    xorg = get_xorg_conf(20 * scale)
+    flags = (get_flags(100 * scale), get_flags(100 * scale, offset=50 * scale))
+    mirrorlist = get_mirrorlist(100 * scale)
+    mirrors = {'countries': ['USA', 'Canada'], 'servers': ['example7.org', 'example13.org']}
+
+    return [('parse_blkid', len(blkid), lambda: gentoo.parse_blkid(blkid)),
+            ('parse_autounmask', len(emerge), lambda: gentoo.parse_autounmask(emerge)),
+            ('get_change_lines', len(emerge_lines),
+             lambda: gentoo.get_change_lines(emerge_lines, 'The following keyword changes')),
+            ('parse_xorg_conf', len(xorg), lambda: gentoo.parse_xorg_conf(xorg)),
+            ('merge_flags', len(flags[0]), lambda: gentoo.merge_flags(*flags)),
+            ('filter_mirrorlist', len(mirrorlist), lambda: arch.filter_mirrorlist(mirrorlist, mirrors))]
+
+
+def run(args):
+    gentoo = GentooInstaller(GENTOO_CONFIG, logpath=os.devnull)
+    arch = ArchInstaller(ARCH_CONFIG, logpath=os.devnull)
+
+    out = sys.stdout
+    if args.output:
+        out = open(args.output, 'w')
+
+    out.write('%-20s %10s %12s %12s\n' % ('benchmark', 'size', 'best (ms)', 'mean (ms)'))
+    for name, size, func in get_benchmarks(gentoo, arch, args.scale):
+        if args.filter and args.filter not in name:
+            continue
+        times = timeit.repeat(func, number=args.number, repeat=args.repeat)
+        times = [t * 1000 / args.number for t in times]
+        out.write('%-20s %10d %12.3f %12.3f\n' % (name, size, min(times), sum(times) / len(times)))
+        out.flush()
+
+    if args.output:
+        out.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the parsers run on command output and config files')
+    parser.add_argument('-s', '--scale', action='store', dest='scale', type=int, default=10,
+                        help='Multiplier for the size of the synthetic inputs (default is 10)')
+    parser.add_argument('-n', '--number', action='store', dest='number', type=int, default=10,
+                        help='Calls per timing (default is 10)')
+    parser.add_argument('-r', '--repeat', action='store', dest='repeat', type=int, default=5,
+                        help='Timings per benchmark (default is 5)')
+    parser.add_argument('-k', '--filter', action='store', dest='filter', required=False,
+                        help='Only run benchmarks with names containing this string')
+    parser.add_argument('-o', '--output', action='store', dest='output', required=False,
+                        help='Path to write the results to (default is stdout)')
+
+    run(parser.parse_args())
@@ -3,11 +3,21 @@ import re
 import grp
 import pwd
 import errno
-import multiprocessing
+import hashlib
+import tempfile
 from shutil import copyfile, rmtree
 from urllib.parse import urlparse
 
-from dist.linux import LinuxInstaller, InstallException, CmdError
+from dist.linux import LinuxInstaller, InstallException, CmdError, KERNEL_CACHE_DIR
+from dist.phases import Phase
+from dist.mirrors import MIRROR_CACHE_TTL
+
+# Location of downloaded packages inside the install target
+PACMAN_CACHE_DIR = '/var/cache/pacman/pkg'
+
+# File used to sample mirror throughput and the pacman names for config architectures
+PACMAN_MIRROR_PROBE = 'core.db'
+ARCH_NAMES = {'amd64': 'x86_64'}
 
 
 class ArchInstaller(LinuxInstaller):
@@ -19,6 +29,23 @@ class ArchInstaller(LinuxInstaller):
         self.mount_point = mount_point
         self.pacman = self.config.get('pacman')
 
+    def get_phases(self):
+
+        '''Get the install phases and the phases each one depends on'''
+
+        return [Phase('prepdisks', [self.prepare_disks], chroot=False, confirm=self.confirm_disk_overwrite),
+                Phase('pacstrap', [self.pacstrap], deps=['prepdisks'], chroot=False),
+                Phase('setupenv', [self.setup_environment], deps=['pacstrap'], chroot=False, rerun=True),
+                Phase('sysconf', [self.config_system_info], deps=['setupenv'], flag='setupenv'),
+                Phase('kernel', [self.build_kernel], deps=['sysconf']),
+                Phase('fstab', [self.format_fstab], deps=['pacstrap']),
+                Phase('packages', [self.get_misc_packages, self.remove_misc_packages], deps=['sysconf']),
+                Phase('services', [self.install_services], deps=['packages']),
+                Phase('dm', [self.config_display_manager], deps=['packages']),
+                Phase('bootloader', [self.config_boot_loader], deps=['kernel', 'fstab']),
+                Phase('network', [self.config_network], deps=['packages']),
+                Phase('users', [self.setup_users], deps=['packages'])]
+
     def config_mirrors(self):
 
         '''Configure the pacman mirrors'''
@@ -38,46 +65,73 @@ class ArchInstaller(LinuxInstaller):
 
         with open(mirror_file, 'r') as f:
             lines = f.readlines()
-            if len(lines) < 2:
-                raise InstallException('Invalid pacman mirrorlist')
 
-            cre = re.compile('(?<=\#\# )[a-zA-Z ]+')
-            sre = re.compile('(?<=Server \= )\S+')
-            out_lines = []
-            for i, l in enumerate(lines):
-                server = sre.search(l)
-                if server:
-                    if not out_lines:
-                        out_lines += lines[: i - 1]
+        out_lines, entries = self.filter_mirrorlist(lines, mirrors)
+
+        # Order the mirrors by how fast they actually are
+        if mirrors.get('rank', True) and entries:
+            arch = ARCH_NAMES.get(self.arch, self.arch)
+            probes = dict([(e[0].replace('$repo', 'core').replace('$arch', arch), e) for e in entries])
+            ranked = self.mirror_ranker.rank(list(probes.keys()), path=PACMAN_MIRROR_PROBE,
+                                             ttl=mirrors.get('ttl', MIRROR_CACHE_TTL))
+            if ranked:
+                entries = [probes[u] for u in ranked]
+                if mirrors.get('count'):
+                    entries = entries[:mirrors['count']]
+            else:
+                self.logger.error('No mirrors could be ranked, keeping the mirrorlist order')
+
+        for server, cline, sline in entries:
+            out_lines += [cline, sline]
+
+        out_lines += '\n'
+        with open(mirror_file, 'w') as wf:
+            wf.writelines(out_lines)
+
+    def filter_mirrorlist(self, lines, mirrors):
+
+        '''Get the mirrorlist header lines and the (server, country line, server line) entries to keep'''
+
+        if len(lines) < 2:
+            raise InstallException('Invalid pacman mirrorlist')
+
+        # See if the country is whitelisted
+        countries = mirrors.get('countries', [])
+        if countries:
+            countries = [c if c != 'usa' else 'united states' for c in [x.lower() for x in countries]]
+        servers = mirrors.get('servers')
 
-                    server = server.group(0)
+        cre = re.compile('(?<=\#\# )[a-zA-Z ]+')
+        sre = re.compile('(?<=Server \= )\S+')
+        out_lines = []
+        entries = []
+        for i, l in enumerate(lines):
+            server = sre.search(l)
+            if server:
+                if not out_lines:
+                    out_lines += lines[: i - 1]
 
-                    sline = l
-                    cline = lines[i - 1]
-                    country = cre.search(cline)
-                    if not country:
-                        raise InstallException('Invalid pacman mirrorlist')
-                    country = country.group(0)
+                server = server.group(0)
 
-                    host = urlparse(server)
-                    host = host[1]
+                sline = l
+                cline = lines[i - 1]
+                country = cre.search(cline)
+                if not country:
+                    raise InstallException('Invalid pacman mirrorlist')
+                country = country.group(0)
 
-                    # See if the country is whitelisted
-                    whitelist = mirrors.get('countries')
-                    if whitelist:
-                        whitelist = [c if c != 'usa' else 'united states' for c in [x.lower() for x in whitelist]]
+                host = urlparse(server)
+                host = host[1]
 
-                    if country.lower() in whitelist:
-                        out_lines += [cline, sline]
+                if country.lower() in countries:
+                    entries.append((server, cline, sline))
+                    continue
 
-                    whitelist = mirrors.get('servers')
-                    if whitelist:
-                        if [s for s in whitelist if s.lower() in host]:
-                            out_lines += [cline, sline]
+                if servers:
+                    if [s for s in servers if s.lower() in host]:
+                        entries.append((server, cline, sline))
 
-            out_lines += '\n'
-            with open(mirror_file, 'w') as wf:
-                wf.writelines(out_lines)
+        return out_lines, entries
 
     def check_chroot(func):
 
@@ -211,6 +265,15 @@ class ArchInstaller(LinuxInstaller):
         if not self.is_mounted(self.mount_point + '/dev'):
             self.exec_cmd(['mount', '--rbind', '--make-rslave', '/dev', self.mount_point + '/dev'])
 
+        # Share downloaded packages with other installs
+        pkg_cache = self.cache.get('pacman')
+        if pkg_cache:
+            self.mount_cache_dir(pkg_cache, PACMAN_CACHE_DIR)
+
+        kernels = self.cache.get('kernel')
+        if kernels:
+            self.mount_cache_dir(kernels, KERNEL_CACHE_DIR)
+
     @check_chroot
     def config_network(self, network={}):
 
@@ -322,13 +385,32 @@ class ArchInstaller(LinuxInstaller):
                         break
             return key_lines
 
+        def _get_cache_key():
+            # The kernel config and PKGBUILD decide what makepkg builds
+            sha = hashlib.sha256()
+            for path in ('config', 'PKGBUILD'):
+                with open(path, 'rb') as f:
+                    sha.update(f.read())
+            return sha.hexdigest()
+
+        def _enable_ccache():
+            # Returns the original BUILDENV so it can be put back after the build
+            buildenv = self.get_file_var(makepkg_conf, 'BUILDENV')
+            if buildenv and '!ccache' in buildenv:
+                self.update_file_var(makepkg_conf, 'BUILDENV', buildenv.replace('!ccache', 'ccache'),
+                                     use_quotes=False)
+                return buildenv
+            return None
+
         base_dir = '/usr/src/linux_build'
         build_dir = base_dir + '/linux/trunk'
         pkg_name = 'linux-custom'
         sudoers = '/etc/sudoers'
+        makepkg_conf = '/etc/makepkg.conf'
         nobody = 'nobody ALL=(ALL) NOPASSWD: ALL\n'
         delete_dirs = []
         perm_cleanups = []
+        buildenv = None
 
         try:
             self.packman_install('extra/asp', flags=['--noconfirm'])
@@ -376,6 +458,16 @@ class ArchInstaller(LinuxInstaller):
                 f.writelines(lines)
                 f.truncate()
 
+            # Install a package built earlier from the same config and PKGBUILD if there is one
+            entry = None
+            if self.cache.get('kernel'):
+                entry = '%s/%s' % (KERNEL_CACHE_DIR, _get_cache_key())
+                if os.path.isdir(entry):
+                    self.logger.info('Installing cached kernel from %s' % (entry))
+                    packages = ['%s/%s' % (entry, p) for p in sorted(os.listdir(entry))]
+                    self.packman_install(packages, flags=['--noconfirm'], local=True)
+                    return
+
             # Get the valid PGPG keys
             keys = _get_valid_pgp_keys('PKGBUILD')
 
@@ -408,17 +500,38 @@ class ArchInstaller(LinuxInstaller):
 
             self.packman_install('base-devel', flags=['--noconfirm'])
 
-            cn = multiprocessing.cpu_count()
+            # Build through ccache when caching so a changed config only rebuilds what it touches
+            env = ''
+            if entry:
+                ccache_dir = '%s/ccache' % (KERNEL_CACHE_DIR)
+                self.packman_install('extra/ccache', flags=['--noconfirm'])
+                buildenv = _enable_ccache()
+                if not os.path.isdir(ccache_dir):
+                    os.mkdir(ccache_dir)
+                self.exec_cmd(['chown', '-R', 'nobody', ccache_dir])
+                env = 'CCACHE_DIR=%s ' % (ccache_dir)
+
+            cn = self.cores
             try:
-                r, o = self.exec_cmd('sudo -u nobody  MAKEFLAGS=\"-j%d\" makepkg -s --noconfirm' % (cn),
-                                     shell=True)
+                r, o = self.exec_cmd('sudo -u nobody  %sMAKEFLAGS=\"-j%d\" makepkg -s --noconfirm' % (env, cn),
+                                     shell=True, capture=False)
             except CmdError as ce:
                 if 'The package group has already been built' not in ce.output:
                     raise ce
 
             packages = [pkg for pkg in os.listdir('.')
-                        if pkg.startswith(pkg_name) and pkg.endswith('pkg.tar.xz')]
+                        if pkg.startswith(pkg_name) and pkg.endswith(('pkg.tar.xz', 'pkg.tar.zst'))]
             self.packman_install(packages, flags=['--noconfirm'], local=True)
+
+            if entry:
+                tmp = tempfile.mkdtemp(dir=KERNEL_CACHE_DIR)
+                for pkg in packages:
+                    copyfile(pkg, '%s/%s' % (tmp, pkg))
+                try:
+                    os.rename(tmp, entry)
+                except OSError:
+                    # Another install stored the same kernel first
+                    rmtree(tmp)
         finally:
             for d in delete_dirs:
                 rmtree(d)
@@ -432,6 +545,9 @@ class ArchInstaller(LinuxInstaller):
                 f.truncate()
             for path, owner, group in perm_cleanups:
                 self.exec_cmd(['chown', '-R', '%s:%s' % (owner, group), path])
+            # Don't leave ccache turned on for makepkg on the installed system
+            if buildenv:
+                self.update_file_var(makepkg_conf, 'BUILDENV', buildenv, use_quotes=False)
 
     @check_chroot
     def build_kernel(self, kernel={}):
@@ -447,7 +563,13 @@ class ArchInstaller(LinuxInstaller):
         self.config_mirrors()
         self.mount_rootfs()
         self.mount_block_devs()
-        self.exec_cmd(['pacstrap', self.mount_point, 'base'])
+
+        # Let pacstrap download into (and reuse) the shared package cache
+        pkg_cache = self.cache.get('pacman')
+        if pkg_cache:
+            self.mount_cache_dir(pkg_cache, PACMAN_CACHE_DIR)
+
+        self.exec_cmd(['pacstrap', self.mount_point, 'base'], capture=False)
 
     @check_chroot
     def config_boot_loader(self, bootldr=''):
@@ -607,6 +729,16 @@ class ArchInstaller(LinuxInstaller):
         if not pkgs:
             pkgs = self.packages
 
+        # Install everything in a single pacman transaction when possible
+        if self.pacman.get('batch', True) and len(pkgs) > 1:
+            try:
+                self.packman_install(list(pkgs), flags=flags + ['--noconfirm', '--needed'])
+                return
+            except CmdError as ce:
+                if not skip_on_fail:
+                    raise ce
+                self.logger.error('Error installing package batch, error=%s, installing one at a time' % (ce.error))
+
         for pkg in pkgs:
             try:
                 self.packman_install(pkg, flags=flags + ['--noconfirm'])
@@ -0,0 +1,227 @@
+import io
+import os
+import re
+import stat
+import tempfile
+import configparser
+
+from collections import OrderedDict
+
+from dist.unix import InstallException
+
+
+def atomic_write(path, data):
+
+    '''Replace a file through a temporary file and a rename so it is never left half written'''
+
+    dirname = os.path.dirname(os.path.abspath(path))
+    mode = 0o644
+    if os.path.exists(path):
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.%s.' % (os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class ConfigFile(object):
+
+    '''A config file read once and kept in memory until flushed'''
+
+    def __init__(self, path):
+        self.path = path
+        self.dirty = False
+        self.lines = []
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.lines = f.readlines()
+
+    def append(self, line):
+        if self.lines and not self.lines[-1].endswith('\n'):
+            self.lines[-1] += '\n'
+        self.lines.append(line)
+
+    def dump(self):
+        return ''.join(self.lines)
+
+    def flush(self):
+        if self.dirty:
+            atomic_write(self.path, self.dump())
+            self.dirty = False
+
+
+class VarFile(ConfigFile):
+
+    '''A shell style VAR="value" file (make.conf, conf.d, etc.) with variables indexed by name'''
+
+    def __init__(self, path):
+        super(VarFile, self).__init__(path)
+
+        self.index = {}
+        for i, l in enumerate(self.lines):
+            self.index.setdefault(l.split('=')[0].strip(), i)
+
+    def get(self, var):
+        i = self.index.get(var)
+        if i is None:
+            return None
+
+        line = self.lines[i]
+        idx = line.find('=')
+        if idx != -1 and idx + 1 != len(line):
+            val = line[idx + 1:]
+            if len(val):
+                return val.strip('\" \t\r\n')
+        return None
+
+    def set(self, var, value, use_quotes=True):
+        kv = '%s=\"%s\"\n' % (var, value)
+        if not use_quotes:
+            kv = '%s=%s\n' % (var, value)
+
+        i = self.index.get(var)
+        if i is None:
+            self.append(kv)
+            self.index[var] = len(self.lines) - 1
+        elif self.lines[i] != kv:
+            self.lines[i] = kv
+        else:
+            return
+        self.dirty = True
+
+    def merge(self, var, new):
+
+        '''Add space separated values to a variable, keeping the ones already set'''
+
+        val = self.get(var)
+        if not val:
+            self.set(var, new)
+            return
+
+        vals = val.split()
+        vals += [n for n in new.split() if n not in vals]
+        self.set(var, ' '.join(vals))
+
+
+class LineFile(ConfigFile):
+
+    '''A file of one entry per line (the portage package.* files)'''
+
+    def __init__(self, path, truncate=False):
+        super(LineFile, self).__init__(path)
+
+        if truncate and self.lines:
+            self.lines = []
+            self.dirty = True
+
+    def add(self, line):
+        line = line.rstrip('\n') + '\n'
+        if line not in self.lines:
+            self.append(line)
+            self.dirty = True
+
+
+class IniFile(ConfigFile):
+
+    '''An INI style file (commonly used in systemd)'''
+
+    def __init__(self, path, strict=True):
+        super(IniFile, self).__init__(path)
+
+        self.cfg = configparser.ConfigParser(strict=strict)
+        self.cfg.optionxform = str
+        self.cfg.read_string(''.join(self.lines), source=path)
+
+    def update(self, fields, merge=False):
+        if merge:
+            for k, v in fields.items():
+                if self.cfg.has_section(k):
+                    for z, x in v.items():
+                        self.cfg.set(k, str(z), str(x))
+                else:
+                    self.cfg.update(fields)
+        else:
+            self.cfg.update(fields)
+        self.dirty = True
+
+    def dump(self):
+        out = io.StringIO()
+        self.cfg.write(out)
+        return out.getvalue()
+
+
+class LvmFile(ConfigFile):
+
+    '''An lvm.conf style file made of "section { var = value }" blocks'''
+
+    def set(self, var, val, section=''):
+        curr_sect = ''
+        for i, l in enumerate(self.lines):
+            hit = re.search('[a-z ]+(?={)', l)
+            if hit and not l.strip().startswith('#'):
+                curr_sect = hit.group(0).strip()
+            if section and curr_sect == section:
+                if var in l and not l.strip().startswith('#'):
+                    splt = l.split('=')
+                    splt[1] = str(val) + '\n'
+                    self.lines[i] = '= '.join(splt)
+                    break
+
+            if not l.strip().startswith('#') and l.strip().startswith('}'):
+                if section and curr_sect == section:
+                    self.lines.insert(i, '\t' + ' = '.join([str(var), str(val)]) + '\n')
+                    break
+        self.dirty = True
+
+
+class ConfigTransaction(object):
+
+    '''Collects edits to several config files and writes each changed file once
+
+    Used as a context manager the files are only written if the block
+    finishes without an exception.
+    '''
+
+    def __init__(self):
+        self.files = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, tb):
+        if typ is None:
+            self.commit()
+
+    def _get(self, cls, path, *args):
+        doc = self.files.get(path)
+        if doc is None:
+            doc = cls(path, *args)
+            self.files[path] = doc
+        elif not isinstance(doc, cls):
+            raise InstallException('Config file %s opened with conflicting formats' % (path))
+        return doc
+
+    def var_file(self, path):
+        return self._get(VarFile, path)
+
+    def line_file(self, path, truncate=False):
+        return self._get(LineFile, path, truncate)
+
+    def ini_file(self, path, strict=True):
+        return self._get(IniFile, path, strict)
+
+    def lvm_file(self, path):
+        return self._get(LvmFile, path)
+
+    def commit(self):
+        for doc in self.files.values():
+            doc.flush()
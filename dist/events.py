@@ -0,0 +1,52 @@
+import os
+import json
+import time
+import threading
+
+# Number of entries listed in each part of the end of run report
+REPORT_COUNT = 10
+
+
+class EventLog(object):
+
+    '''Writes install events (phases, commands and downloads) to a file as JSON lines
+
+    The file is opened up front so events can still be written once the
+    installer has entered the chroot.
+    '''
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.lock = threading.Lock()
+        self.file = open(self.path, 'a', buffering=1)
+
+    def emit(self, event, **fields):
+        fields['event'] = event
+        fields.setdefault('time', time.time())
+        with self.lock:
+            self.file.write(json.dumps(fields, sort_keys=True) + '\n')
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def get_report(phase_stats, cmd_stats, count=REPORT_COUNT):
+
+    '''Get the lines of a report listing the slowest phases and commands'''
+
+    lines = ['Slowest phases:']
+    for s in sorted(phase_stats, key=lambda s: s['wall'], reverse=True)[:count]:
+        lines.append('  %9.1fs  %-16s %s (commands %.1fs cpu, python %.1fs cpu)' %
+                     (s['wall'], s['phase'], s['status'], s['cmd_cpu'], s['python_cpu']))
+
+    lines.append('Slowest commands:')
+    for s in sorted(cmd_stats, key=lambda s: s['wall'], reverse=True)[:count]:
+        cmd = s['cmd']
+        if len(cmd) > 80:
+            cmd = cmd[:77] + '...'
+        lines.append('  %9.1fs  %8.1fs cpu  [%s] %s' % (s['wall'], s['cpu'], s.get('phase') or '-', cmd))
+
+    lines.append('Commands run: %d (%.1fs wall, %.1fs cpu)' %
+                 (len(cmd_stats), sum([s['wall'] for s in cmd_stats]), sum([s['cpu'] for s in cmd_stats])))
+    return lines
@@ -0,0 +1,250 @@
+import os
+import copy
+import json
+import math
+import uuid
+import logging
+import traceback
+import multiprocessing
+
+from multiprocessing.connection import wait
+
+from dist.unix import InstallException
+from dist.phases import PhaseScheduler
+from dist.events import EventLog
+
+# Phases that need someone at the terminal (passwords) and are left out of fleet installs
+INTERACTIVE_PHASES = ['users']
+
+# Cache directories every target of a fleet shares, relative to the fleet cache root
+FLEET_CACHE_DIRS = ['stage', 'binpkgs', 'distfiles', 'repos', 'kernel', 'pacman']
+
+
+def rename_volgroup_paths(val, renames):
+
+    '''Point the /dev paths of volume groups in a config value at the renamed groups'''
+
+    if isinstance(val, dict):
+        return dict([(k, rename_volgroup_paths(v, renames)) for k, v in val.items()])
+    if isinstance(val, list):
+        return [rename_volgroup_paths(v, renames) for v in val]
+    if not isinstance(val, str):
+        return val
+
+    for old, new in renames.items():
+        val = val.replace('/dev/%s/' % (old), '/dev/%s/' % (new))
+        # Device mapper names double any dash in the volume group name
+        val = val.replace('/dev/mapper/%s-' % (old.replace('-', '--')), '/dev/mapper/%s-' % (new.replace('-', '--')))
+    return val
+
+
+class FleetJob(object):
+
+    '''A single install target of a fleet
+
+    devices maps the disk names used in the install config to the disks of
+    this target, so several targets can be installed from one config. Volume
+    groups are given the job name as a suffix since they are named on the host.
+    '''
+
+    def __init__(self, name, config, mount_point, kconfig=None, devices={}, logpath=None):
+        self.name = name
+        self.config = config
+        self.mount_point = mount_point
+        self.kconfig = kconfig
+        self.devices = devices
+        self.logpath = logpath or '%s.log' % (name)
+        self.path = None
+        self.events = None
+
+        with open(config, 'r') as f:
+            self.cfg = json.load(f)
+
+    def remap_device(self, dev):
+
+        '''Get the target device for a device (or one of its partitions) named in the config'''
+
+        for src, dst in self.devices.items():
+            if dev == src:
+                return dst
+
+            idx = dev[len(src):].lstrip('p')
+            if dev.startswith(src) and idx.isdigit():
+                if dst.lower().startswith('/dev/nvme'):
+                    return '%sp%s' % (dst, idx)
+                return '%s%s' % (dst, idx)
+        return dev
+
+    def get_config(self, cache, cores, load, sync_token):
+
+        '''Build the install config for this target'''
+
+        cfg = copy.deepcopy(self.cfg)
+
+        for d in cfg.get('disks', []):
+            d['name'] = self.remap_device(d['name'])
+            for p in d['partitions']:
+                if p.get('crypt'):
+                    raise InstallException('%s: encrypted partitions need a passphrase and can not be '
+                                           'part of a fleet install' % (self.name))
+
+        renames = {}
+        for lvm in cfg.get('lvms', []):
+            lvm['physvol'] = self.remap_device(lvm['physvol'])
+            for g in lvm['volgroups']:
+                renames[g['name']] = '%s_%s' % (g['name'], self.name)
+                g['name'] = renames[g['name']]
+        cfg = rename_volgroup_paths(cfg, renames)
+
+        cfg.setdefault('cache', {}).update(cache)
+
+        # Keep each target to its share of the host, packages built at once times make jobs
+        # stays within the share and the load average caps the host as a whole
+        cfg['cores'] = cores
+        if cfg.get('portage') is not None:
+            cfg['portage']['jobs'] = max(1, math.isqrt(cores))
+            cfg['portage']['load_average'] = load
+            cfg['portage']['sync_token'] = sync_token
+
+        return cfg
+
+    def get_disks(self):
+        return [self.remap_device(d['name']) for d in self.cfg.get('disks', [])]
+
+
+def run_job(installer, job, names, resume):
+
+    '''Install a single target, run in its own process since the chroot is process wide'''
+
+    # The fork inherits the handlers of the fleet logger, start again with the ones for this target
+    logger = logging.getLogger('sup')
+    [logger.removeHandler(h) for h in list(logger.handlers)]
+
+    inst = installer(job.path, mount_point=job.mount_point, kconfig=job.kconfig, logpath=job.logpath)
+    inst.confirm_disks = False
+    if job.events:
+        inst.events = EventLog(job.events)
+
+    # Tell the targets apart in the shared terminal output
+    fmt = logging.Formatter('%%(asctime)s - %s - %%(levelname)s - %%(message)s' % (job.name))
+    [h.setFormatter(fmt) for h in inst.logger.handlers]
+
+    try:
+        PhaseScheduler(inst, inst.get_phases(), job.path).run(names, resume=resume)
+    except Exception:
+        inst.logger.error('Install failed:\n%s' % (traceback.format_exc()))
+        raise SystemExit(1)
+
+
+class Fleet(object):
+
+    '''Installs several targets at once, each one in a separate worker process
+
+    All targets share one set of cache directories so the stage, the portage
+    tree, source downloads and binary packages are only fetched or built once.
+    The host cores are split between the targets running at the same time.
+    '''
+
+    def __init__(self, installer, jobs, cache_dir, workdir='fleet', max_jobs=None, cores=None, events=False):
+        self.installer = installer
+        self.jobs = jobs
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.workdir = workdir
+        self.max_jobs = min(max_jobs or len(jobs), len(jobs))
+        self.cores = cores or multiprocessing.cpu_count()
+        self.events = events
+        self.logger = logging.getLogger('sup')
+
+        self.check_jobs()
+
+    def check_jobs(self):
+
+        '''Make sure targets don't share anything that lives on the host'''
+
+        for attr in ('name', 'mount_point'):
+            vals = [getattr(j, attr) for j in self.jobs]
+            dups = set([v for v in vals if vals.count(v) > 1])
+            if dups:
+                raise InstallException('Fleet jobs share a %s: %s' % (attr, ', '.join(dups)))
+
+        disks = [d for j in self.jobs for d in j.get_disks()]
+        dups = set([d for d in disks if disks.count(d) > 1])
+        if dups:
+            raise InstallException('Fleet jobs share disks: %s' % (', '.join(dups)))
+
+    def confirm_disks(self):
+
+        '''Confirm every disk of every target before starting any of the installs'''
+
+        for j in self.jobs:
+            for disk in j.get_disks():
+                dev_name = input('!!! WARNING: All data on %s (%s) will be erased; '
+                                 'enter the device name to confirm: ' % (disk, j.name))
+                if dev_name != disk:
+                    raise Exception('Failed to confirm disk overwrite, exiting')
+
+    def get_sync_token(self, resume=False):
+
+        '''Get the token that makes the targets of a run sync the shared portage tree only once'''
+
+        path = os.path.join(self.workdir, 'sync_token')
+        if resume and os.path.exists(path):
+            with open(path, 'r') as f:
+                return f.read().strip()
+
+        token = uuid.uuid4().hex
+        with open(path, 'w') as f:
+            f.write(token)
+        return token
+
+    def write_configs(self, resume=False):
+
+        '''Write the install config (and set the event log) of each target in the work directory'''
+
+        cache = dict([(c, os.path.join(self.cache_dir, c)) for c in FLEET_CACHE_DIRS])
+        cache['mirrors'] = os.path.join(self.cache_dir, 'mirrors.json')
+
+        cores = max(1, self.cores // self.max_jobs)
+
+        os.makedirs(self.workdir, exist_ok=True)
+        sync_token = self.get_sync_token(resume)
+        for j in self.jobs:
+            j.path = os.path.join(self.workdir, '%s.cfg' % (j.name))
+            if self.events:
+                j.events = os.path.join(self.workdir, '%s.events.jsonl' % (j.name))
+            with open(j.path, 'w') as f:
+                json.dump(j.get_config(cache, cores, self.cores, sync_token), f, indent=4)
+
+    def run(self, names, resume=False):
+
+        '''Install every target, returns the names of the ones that failed'''
+
+        names = [n for n in names if n not in INTERACTIVE_PHASES]
+
+        if 'prepdisks' in names:
+            self.confirm_disks()
+        self.write_configs(resume)
+
+        ctx = multiprocessing.get_context('fork')
+        pending = list(self.jobs)
+        running = {}
+        failed = []
+
+        while pending or running:
+            while pending and len(running) < self.max_jobs:
+                j = pending.pop(0)
+                p = ctx.Process(target=run_job, args=(self.installer, j, names, resume), name=j.name)
+                p.start()
+                self.logger.info('Started fleet install: %s' % (j.name))
+                running[p.sentinel] = (p, j)
+
+            for s in wait(list(running)):
+                p, j = running.pop(s)
+                p.join()
+                if p.exitcode:
+                    self.logger.error('Fleet install failed: %s (see %s)' % (j.name, j.logpath))
+                    failed.append(j.name)
+                else:
+                    self.logger.info('Fleet install finished: %s' % (j.name))
+
+        return failed
@@ -1,16 +1,38 @@
 import os
 import re
 import ssl
+import json
 import time
 import errno
+import fcntl
 import shutil
 import hashlib
 import tempfile
-import binascii
+import http.client
 import urllib.request
-import multiprocessing
 
-from dist.linux import LinuxInstaller, InstallException, CmdError
+from urllib.parse import urlparse
+from xml.etree import ElementTree
+
+from dist.unix import lock_file
+from dist.linux import LinuxInstaller, InstallException, CmdError, KERNEL_CACHE_DIR
+from dist.phases import Phase
+from dist.mirrors import MIRROR_CACHE_TTL
+from dist.conffile import ConfigTransaction, LineFile
+
+DOWNLOAD_CHUNK_SIZE = 0x10000
+
+# Location of binary packages, source downloads and repositories inside the install target
+BINPKG_DIR = '/var/cache/binpkgs'
+DISTFILES_DIR = '/var/cache/distfiles'
+REPOS_DIR = '/var/db/repos'
+
+# Seconds a repository shared between installs counts as freshly synced
+REPOS_SYNC_TTL = 3600
+
+# Official mirror lists and the file used to sample mirror throughput
+GENTOO_MIRRORS_URL = 'https://api.gentoo.org/mirrors/%s.xml'
+GENTOO_MIRROR_PROBE = 'snapshots/portage-latest.tar.xz'
 
 
 class GentooInstaller(LinuxInstaller):
@@ -26,6 +48,11 @@ class GentooInstaller(LinuxInstaller):
         self.portage = self.config.get('portage')
         self.stage = self.config.get('stage')
         self.packages_to_cleanup = []
+        self.stage_path = None
+        self.mirror_xml = {}
+
+        # Shared lock held on a repository shared with other installs while it is in use
+        self.repos_lock = None
 
         # Automated Weekly Release Key (https://www.gentoo.org/downloads/signatures/)
         self.eng_key_id = '13EBBDBEDE7A12775DFDB1BABB572E0E2D182910'
@@ -50,6 +77,35 @@ class GentooInstaller(LinuxInstaller):
 
         return wrap
 
+    def get_phases(self):
+
+        '''Get the install phases and the phases each one depends on'''
+
+        # Without a stage cache the stage is downloaded onto the target root
+        stage_deps = []
+        if not self.cache.get('stage'):
+            stage_deps = ['prepdisks']
+
+        return [Phase('prepdisks', [self.prepare_disks, self.mount_rootfs], chroot=False,
+                      confirm=self.confirm_disk_overwrite),
+                Phase('fetch_stage', [self.fetch_stage], deps=stage_deps, flag='getstage',
+                      chroot=False, background=True),
+                Phase('getstage', [self.extract_stage], deps=['prepdisks', 'fetch_stage'], chroot=False),
+                Phase('setupenv', [self.setup_environment], deps=['getstage'], chroot=False, rerun=True),
+                Phase('rank_mirrors', [self.rank_mirrors], flag='config_portage', chroot=False, background=True),
+                Phase('config_portage', [self.config_portage], deps=['setupenv', 'rank_mirrors']),
+                Phase('sysconf', [self.config_system_info], deps=['config_portage']),
+                Phase('update_world', [self.update_world_set], deps=['config_portage', 'sysconf']),
+                Phase('kernel', [self.build_kernel], deps=['update_world']),
+                Phase('fstab', [self.format_fstab], deps=['setupenv']),
+                Phase('packages', [self.get_misc_packages], deps=['update_world']),
+                Phase('network', [self.config_network], deps=['packages']),
+                Phase('services', [self.install_services], deps=['packages', 'network']),
+                Phase('bootloader', [self.config_boot_loader], deps=['kernel', 'fstab']),
+                Phase('misc_config', [self.do_misc_config], deps=['packages']),
+                Phase('display', [self.config_display], deps=['packages']),
+                Phase('users', [self.setup_users], deps=['packages'])]
+
     def set_path(self):
         # Set the PATH inside of the chroot
         res = '(?<=[^A-Z]PATH=)\S+'
@@ -63,29 +119,32 @@ class GentooInstaller(LinuxInstaller):
             else:
                 raise InstallException('Failed to set chroot PATH')
 
-    def set_package_value(self, path, name, *vals):
+    def set_package_value(self, path, name, *vals, tx=None):
 
-        '''Update a value for a package specific config'''
+        '''Update a value for a package specific config
+
+        When a ConfigTransaction is given the change is written when it commits.
+        '''
 
         nv = ' '.join(vals)
 
+        commit = tx is None
+        if commit:
+            tx = ConfigTransaction()
+
         if not os.path.isdir(path):
             # If it's a file, add to it
-            with open(path, 'r') as f:
-                lines = f.readlines()
-                lines.append(nv)
-                f.seek(0)
-                f.writelines(lines)
-                f.truncate()
+            tx.line_file(path).add(nv)
 
         # Its a directory, make a new file
         else:
             path = '%s/%s' % (path, name)
-            with open(path, 'w') as f:
-                f.write(nv + '\n')
-                f.truncate()
+            tx.line_file(path, truncate=True).add(nv)
 
-    def set_package_use(self, name, package, flags):
+        if commit:
+            tx.commit()
+
+    def set_package_use(self, name, package, flags, tx=None):
 
         '''Update local USE flags for a package'''
 
@@ -93,9 +152,9 @@ class GentooInstaller(LinuxInstaller):
         if not os.path.exists(path):
             os.mkdir(path)
 
-        self.set_package_value(path, name, package, flags)
+        self.set_package_value(path, name, package, flags, tx=tx)
 
-    def set_package_mask(self, name, package):
+    def set_package_mask(self, name, package, tx=None):
 
         '''Update Masks for a package'''
 
@@ -103,9 +162,9 @@ class GentooInstaller(LinuxInstaller):
         if not os.path.exists(path):
             os.mkdir(path)
 
-        self.set_package_value(path, name, package)
+        self.set_package_value(path, name, package, tx=tx)
 
-    def set_package_license(self, name, package, flags):
+    def set_package_license(self, name, package, flags, tx=None):
 
         '''Update Licenses for a package'''
 
@@ -113,9 +172,9 @@ class GentooInstaller(LinuxInstaller):
         if not os.path.exists(path):
             os.mkdir(path)
 
-        self.set_package_value(path, name, package, flags)
+        self.set_package_value(path, name, package, flags, tx=tx)
 
-    def set_package_accept(self, name, package, keywords):
+    def set_package_accept(self, name, package, keywords, tx=None):
 
         '''Update keywords for a package'''
 
@@ -123,7 +182,7 @@ class GentooInstaller(LinuxInstaller):
         if not os.path.exists(path):
             os.mkdir(path)
 
-        self.set_package_value(path, name, package, keywords)
+        self.set_package_value(path, name, package, keywords, tx=tx)
 
     def _get_stage_url(self, stage):
         stagepath = stage.split('/')
@@ -157,67 +216,221 @@ class GentooInstaller(LinuxInstaller):
         path = '%s%s' % (baseurl, target)
         return path
 
+    def _open_url(self, url, offset=0):
+
+        '''Open a URL, optionally requesting the content from a byte offset'''
+
+        req = urllib.request.Request(url)
+        if offset:
+            req.add_header('Range', 'bytes=%d-' % (offset))
+        return urllib.request.urlopen(req, context=ssl._create_unverified_context())
+
+    def download_file(self, url, path, retry_count=10):
+
+        '''Stream a URL to disk and return the SHA512 hex digest of the file
+
+        Data is hashed as it arrives. A partial file left by a previous attempt
+        at path + '.part' is hashed and resumed with an HTTP Range request.
+        '''
+
+        part = '%s.part' % (path)
+        sha = hashlib.sha512()
+        offset = 0
+        start = time.time()
+
+        # Account for anything a previous attempt already wrote
+        if os.path.exists(part):
+            with open(part, 'rb') as f:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    sha.update(chunk)
+                    offset += len(chunk)
+            self.logger.info('Resuming download of %s at byte %d' % (url, offset))
+
+        for i in range(retry_count):
+            try:
+                with self._open_url(url, offset) as t:
+                    if offset and t.status != 206:
+                        # The server ignored the range request, start over
+                        self.logger.info('Server does not support resume, restarting download')
+                        sha = hashlib.sha512()
+                        offset = 0
+
+                    total = offset + (t.length or 0)
+                    with open(part, 'ab' if offset else 'wb') as f:
+                        while True:
+                            chunk = t.read(DOWNLOAD_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            f.write(chunk)
+                            sha.update(chunk)
+                            offset += len(chunk)
+                            if total:
+                                print('\r[*] Downloading %s... [%.01f%%]' %
+                                      (os.path.basename(path), 100 * float(offset) / float(total)), end='')
+                    print('\n')
+
+                    if total and offset < total:
+                        raise http.client.IncompleteRead(b'', total - offset)
+
+            except urllib.error.HTTPError as err:
+                # Requested range starts at the end of the file, nothing left to fetch
+                if err.code != 416 or not offset:
+                    raise err
+            except (urllib.error.URLError, http.client.HTTPException, OSError):
+                self.logger.info('Download of %s interrupted at byte %d, resuming...' % (url, offset))
+                time.sleep(1)
+                continue
+            break
+        else:
+            raise InstallException('Failed to download %s' % (url))
+
+        os.rename(part, path)
+        if self.events:
+            self.events.emit('download', url=url, phase=getattr(self.current_phase, 'name', None),
+                             start=start, wall=time.time() - start, bytes=offset)
+        return sha.hexdigest()
+
+    def _get_stage_cache_index(self, cache_dir):
+        path = os.path.join(cache_dir, 'index.json')
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def _set_stage_cache_index(self, cache_dir, index):
+        with tempfile.NamedTemporaryFile('w', dir=cache_dir, delete=False) as tmp:
+            json.dump(index, tmp, indent=4)
+        os.replace(tmp.name, os.path.join(cache_dir, 'index.json'))
+
+    def get_cached_stage(self, stage, cache_dir, stage_url=None):
+
+        '''Return the path of a previously verified stage in the local cache (if any)
+
+        Entries are keyed on the dated stage file the stage url resolves to. Without
+        a url (the release listing couldn't be fetched) the newest entry for the
+        stage is used.
+        '''
+
+        index = self._get_stage_cache_index(cache_dir)
+        if stage_url:
+            entry = index.get(os.path.basename(stage_url))
+        else:
+            entries = [e for e in index.values() if e.get('stage') == stage]
+            entry = max(entries, key=lambda e: e['time']) if entries else None
+        if not entry:
+            return None
+
+        path = os.path.join(cache_dir, entry['file'])
+        if not os.path.exists(path):
+            return None
+
+        # Files are named by their digest, make sure the contents still match
+        sha = hashlib.sha512()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                sha.update(chunk)
+        if sha.hexdigest() != entry['sha512']:
+            self.logger.error('Cached stage %s is corrupt, ignoring it' % (path))
+            return None
+        return path
+
+    def verify_stage(self, tarsha, digests):
+
+        '''Check a stage digest and the signature of its DIGESTS file'''
+
+        h = re.compile(b'(?<=SHA512 HASH\n)[a-fA-F0-9]+')
+        hit = h.search(digests)
+        if not hit or hit.group(0).decode('utf-8').lower() != tarsha:
+            raise InstallException('Stage hash mismatch')
+
+        self.logger.info('Verifying stage signatures...')
+        with tempfile.NamedTemporaryFile() as tmp:
+            tmp.write(digests)
+            tmp.flush()
+            self.exec_cmd(['gpg', '--keyserver', self.key_server, '--recv-keys', self.eng_key_id])
+            rv, output = self.exec_cmd(['gpg', '--verify', tmp.name])
+            if 'Good signature' not in output:
+                raise InstallException('Signature check failed')
+
     # Can't be chroot'd here since it will break DNS
-    def get_stage(self, stage=''):
+    def fetch_stage(self, stage=''):
 
-        '''Downloads and verifies an install stage specified in the config file from gentoo.org'''
+        '''Downloads and verifies an install stage specified in the config file from gentoo.org
 
-        retry_count = 100
-        got_stage = False
-        got_digests = False
-        verified_sig = False
+        The stage is streamed to the stage cache directory if one is configured,
+        otherwise to the mounted root file system. Returns the path of the stage.
+        '''
 
         if not stage:
             stage = self.stage
 
+        cache_dir = self.cache.get('stage')
+        if not cache_dir:
+            self.mount_rootfs()
+            self.stage_path = self.download_stage(stage, self.mount_point)
+            return self.stage_path
+
+        # The stage names a rolling release, find the file it currently points to
+        try:
+            stage_url = self._get_stage_url(stage)
+        except (InstallException, urllib.error.URLError, OSError):
+            self.logger.error('Unable to look up the current stage, trying the stage cache')
+            stage_url = None
+
+        # Installs sharing the cache wait on one download instead of each fetching the stage
+        os.makedirs(cache_dir, exist_ok=True)
+        with lock_file(os.path.join(cache_dir, '.lock')):
+            path = self.get_cached_stage(stage, cache_dir, stage_url)
+            if path:
+                self.logger.info('Using cached stage: %s' % (path))
+            else:
+                path = self.download_stage(stage, cache_dir, cache_dir=cache_dir, stage_url=stage_url)
+
+        self.stage_path = path
+        return path
+
+    def download_stage(self, stage, dl_dir, cache_dir=None, stage_url=None):
+
+        '''Download and verify a stage into dl_dir, adding it to the stage cache if one is given'''
+
+        retry_count = 100
+        got_stage = False
+        got_digests = False
+
         self.logger.info('Downloading stage...')
 
         # Depending on mirrors, etc. we can sometimes not find a suitable stage url,
         # retry multiple times before we give up
         for i in range(retry_count):
             try:
-                stage_url = self._get_stage_url(stage)
+                if not stage_url:
+                    stage_url = self._get_stage_url(stage)
                 self.logger.info('Getting stage from: %s' % (stage_url))
-                # Get the tarball
-                with urllib.request.urlopen('%s' % stage_url, context=ssl._create_unverified_context()) as t:
-                    tar = b''
-                    tsize = t.length
-                    while t.length:
-                        # TODO remove this magic val
-                        tar += t.read(0x10000)
-                        print("\r[*] Downloading Stage... [%.01f%%]" %
-                              (100 * float(tsize - t.length) / float(tsize)), end='')
-                    print('\n')
-                    self.logger.info('Stage downloaded')
-
-                    sha = hashlib.sha512()
-                    sha.update(tar)
-                    sha = sha.digest()
-                    tarsha = binascii.hexlify(sha)
-                    got_stage = True
+                path = os.path.join(dl_dir, os.path.basename(stage_url))
+                tarsha = self.download_file(stage_url, path)
+                self.logger.info('Stage downloaded')
+                got_stage = True
             except urllib.error.HTTPError:
                 time.sleep(1)
                 self.logger.info('Got HTTP 404... retrying...')
+                stage_url = None
                 continue
             except InstallException:
                 self.logger.info('Failed to find stage url... retrying...')
+                stage_url = None
                 continue
             break
 
         if not got_stage:
             raise InstallException('Failed to download stage')
 
-        # Get the DIGESTS
+        # Get the DIGESTS, used for both the hash and the signature check
         for i in range(retry_count):
             try:
                 digests = '%s.DIGESTS' % (stage_url)
                 self.logger.info('Getting stage digests from %s' % (digests))
-                with urllib.request.urlopen(digests, context=ssl._create_unverified_context()) as d:
-                    h = re.compile(b'(?<=SHA512 HASH\n)[a-fA-F0-9]+')
-                    hashes = d.read()
-                    hit = h.search(hashes).group(0)
-                    if tarsha != hit:
-                        raise InstallException('Stage hash mismatch')
+                with self._open_url(digests) as d:
+                    digests = d.read()
                     got_digests = True
             except urllib.error.HTTPError:
                 time.sleep(1)
@@ -228,36 +441,47 @@ class GentooInstaller(LinuxInstaller):
         if not got_digests:
             raise InstallException('Failed to download digests')
 
-        # Verify the digital signature
-        for i in range(retry_count):
-            try:
-                with tempfile.NamedTemporaryFile() as tmp:
-                    digests = '%s.DIGESTS' % (stage_url)
-                    self.logger.info('Getting stage signature from %s' % (digests))
-                    self.logger.info('Verifying stage signatures...')
-                    with urllib.request.urlopen(digests, context=ssl._create_unverified_context()) as asc:
-                        tmp.write(asc.read())
-                        tmp.flush()
-                        self.exec_cmd(['gpg', '--keyserver', self.key_server, '--recv-keys', self.eng_key_id])
-                        rv, output = self.exec_cmd(['gpg', '--verify', tmp.name])
-                        if 'Good signature' not in output:
-                            raise InstallException('Signature check failed')
-                        verified_sig = True
-            except urllib.error.HTTPError:
-                time.sleep(1)
-                self.logger.info('Got HTTP 404... retrying...')
-                continue
-            break
+        try:
+            self.verify_stage(tarsha, digests)
+        except InstallException:
+            os.unlink(path)
+            raise
+
+        if cache_dir:
+            # Store the verified stage under its digest so later installs can skip the network
+            fname = '%s.tar%s' % (tarsha, os.path.splitext(path)[1])
+            cached = os.path.join(cache_dir, fname)
+            os.replace(path, cached)
+            path = cached
+
+            index = self._get_stage_cache_index(cache_dir)
+            index[os.path.basename(stage_url)] = {'file': fname, 'sha512': tarsha, 'url': stage_url,
+                                                  'stage': stage, 'time': time.time()}
+            self._set_stage_cache_index(cache_dir, index)
+
+        return path
 
-        if not verified_sig:
-            raise InstallException('Failed to verify stage signature')
+    def extract_stage(self, path=''):
+
+        '''Extracts a downloaded stage onto the mount point, downloading it first if needed'''
+
+        if not path:
+            path = self.stage_path or self.fetch_stage()
 
         self.mount_rootfs()
+        self.exec_cmd(['tar', 'xpf', path, '--xattrs', '-C', self.mount_point], capture=False)
 
-        with tempfile.NamedTemporaryFile() as tmp:
-            tmp.write(tar)
-            tmp.flush()
-            self.exec_cmd(['tar', 'xpf', tmp.name, '--xattrs', '-C', self.mount_point])
+        # Only keep the tarball around if it belongs to the cache
+        if not self.cache.get('stage'):
+            os.unlink(path)
+        self.stage_path = None
+
+    # Can't be chroot'd here since it will break DNS
+    def get_stage(self, stage=''):
+
+        '''Downloads, verifies, and extracts an install stage onto the mount point'''
+
+        self.extract_stage(self.fetch_stage(stage))
 
     def setup_environment(self, init='', portage={}):
 
@@ -286,8 +510,9 @@ class GentooInstaller(LinuxInstaller):
             self.exec_cmd(['mount', '--rbind', '/dev', self.mount_point + '/dev'])
 
         # Mount /run
-        r, o = self.exec_cmd(['mount', '--bind', '/run', self.mount_point + '/run'])
-        r, o = self.exec_cmd(['mount', '--make-slave', self.mount_point + '/run'])
+        if not self.is_mounted(self.mount_point + '/run'):
+            r, o = self.exec_cmd(['mount', '--bind', '/run', self.mount_point + '/run'])
+            r, o = self.exec_cmd(['mount', '--make-slave', self.mount_point + '/run'])
 
         if init == 'systemd':
             self.exec_cmd(['mount', '--make-rslave', self.mount_point + '/sys'])
@@ -302,6 +527,24 @@ class GentooInstaller(LinuxInstaller):
         # Copy the DNS info
         self.exec_cmd(['cp', '-f', '-L', '/etc/resolv.conf', self.mount_point + '/etc/'])
 
+        # Share binary packages with other installs
+        binpkgs = self.cache.get('binpkgs')
+        if binpkgs:
+            self.mount_cache_dir(binpkgs, BINPKG_DIR)
+
+        kernels = self.cache.get('kernel')
+        if kernels:
+            self.mount_cache_dir(kernels, KERNEL_CACHE_DIR)
+
+        # Share source downloads and the synced repositories with other installs
+        distfiles = self.cache.get('distfiles')
+        if distfiles:
+            self.mount_cache_dir(distfiles, DISTFILES_DIR)
+
+        repos = self.cache.get('repos')
+        if repos:
+            self.mount_cache_dir(repos, REPOS_DIR)
+
     @check_chroot
     def update_world_set(self):
         '''Update the portage @world set'''
@@ -313,7 +556,8 @@ class GentooInstaller(LinuxInstaller):
         self.emerge_package('media-libs/freetype', flags=['--quiet-build', '--oneshot'],
                     env={**os.environ, **{'USE': '-harfbuzz'}})
         
-        self.emerge_package(name='@world', flags=['--update', '--deep', '--newuse', '--quiet', '--quiet-build'])
+        self.emerge_package(name='@world', flags=['--update', '--deep', '--newuse', '--quiet', '--quiet-build'] +
+                            self.get_emerge_job_flags())
 
     def trust_key(self, keyid, trustlevel):
 
@@ -332,45 +576,70 @@ class GentooInstaller(LinuxInstaller):
                              % (trust),
                              shell=True)
 
-    def get_mirror_list(self, mirror_conf, rsync_mode=False):
-        mirrorselect_cmd = ['mirrorselect', '-q', '-o']
+    def get_mirror_candidates(self, country, rsync_mode=False):
+
+        '''Get the URLs of the full mirrors in a country from the Gentoo mirror list'''
+
+        protos = ('http', 'https')
         if rsync_mode:
-            mirrorselect_cmd.append('-r')
+            protos = ('rsync',)
+
+        # The mirror list is only downloaded once per run
+        kind = 'rsync' if rsync_mode else 'distfiles'
+        if kind not in self.mirror_xml:
+            with self._open_url(GENTOO_MIRRORS_URL % (kind)) as f:
+                self.mirror_xml[kind] = f.read()
+        root = ElementTree.fromstring(self.mirror_xml[kind])
+
+        urls = []
+        for group in root.iter('mirrorgroup'):
+            if country.lower() not in (group.get('country', '').lower(), group.get('countryname', '').lower()):
+                continue
+            for uri in group.iter('uri'):
+                if uri.get('protocol') in protos and uri.get('partial', 'n') == 'n' and uri.text:
+                    urls.append(uri.text.strip())
+        return urls
 
-        if not self.which('mirrorselect'):
-            self.do_chroot()
-            if not self.which('mirrorselect'):
-                # emerge mirrorselect
-                try:
-                    self.exec_cmd(['emerge', '--quiet-build', '--oneshot', 'mirrorselect'])
-                except CmdError as err:
-                    if err.code != errno.EPERM:
-                        raise err
-                    self.resync()
-                    self.exec_cmd(['emerge', '--quiet-build', '--oneshot', 'mirrorselect'])
-
-        # Set the package mirrors
-        country = mirror_conf.get('country')
-        urls = mirror_conf.get('urls')
-        if country:
-            mirrorselect_cmd += ['-c', country]
-        else:
-            mirrorselect_cmd += ['-c', 'USA']
-        r, o = self.exec_cmd(mirrorselect_cmd)
+    def get_mirror_list(self, mirror_conf, rsync_mode=False):
+
+        '''Get the fastest mirrors, a space separated list or a single rsync host'''
+
+        country = mirror_conf.get('country', 'USA')
+        urls = mirror_conf.get('urls', [])
+        ttl = mirror_conf.get('ttl', MIRROR_CACHE_TTL)
+
+        def _get_candidates():
+            candidates = self.get_mirror_candidates(country, rsync_mode)
+            if not rsync_mode:
+                candidates += [u for u in urls if u not in candidates]
+            return candidates
+
+        # Key the ranking on the config so a cached one is used without fetching the mirror list
+        key = json.dumps([country.lower(), rsync_mode, sorted(urls)])
+        ranked = self.mirror_ranker.rank(_get_candidates, path=GENTOO_MIRROR_PROBE, ttl=ttl, key=key)
+        if not ranked:
+            raise InstallException('No reachable mirrors found for %s' % (country))
 
         if rsync_mode:
-            output = o.split()
-            if output[0] != 'sync-uri':
-                raise InstallException('Got invalid sync uri format')
-            mirror_list = output[-1]
+            return 'rsync://%s' % (urlparse(ranked[0]).netloc)
 
-        else:
+        # Always keep the mirrors given in the config
+        mirror_list = ranked[:mirror_conf.get('count', 3)]
+        mirror_list += [u for u in urls if u not in mirror_list]
+        return ' '.join(mirror_list)
 
-            if urls:
-                o = self.merge_flags_with_list(o, urls)
+    def rank_mirrors(self, mirrors={}):
 
-            mirror_list = o.split('\"')[1]
-        return mirror_list
+        '''Rank the distfile and rsync mirrors ahead of configuring portage'''
+
+        if not mirrors:
+            mirrors = self.portage.get('mirrors', {})
+        if not mirrors:
+            return
+
+        self.get_mirror_list(mirrors)
+        if not mirrors.get('rsync'):
+            self.get_mirror_list(mirrors, rsync_mode=True)
 
     def set_rsync_mirror(self, mirrors={}):
 
@@ -386,7 +655,12 @@ class GentooInstaller(LinuxInstaller):
             rsync_mirror = self.get_mirror_list(mirrors, rsync_mode=True)
             rsync_mirror += '/gentoo-portage/'
 
-        cfg = {'gentoo': {'location': '/usr/portage',
+        # A repository shared between installs lives in the bind mounted repos directory
+        location = '/usr/portage'
+        if self.cache.get('repos'):
+            location = '%s/gentoo' % (REPOS_DIR)
+
+        cfg = {'gentoo': {'location': location,
                           'sync-type': 'rsync',
                           'sync-uri': rsync_mirror,
                           'sync-webrsync-verify-signature': 'true',
@@ -425,39 +699,54 @@ class GentooInstaller(LinuxInstaller):
         # Enter the chroot
         self.do_chroot()
 
-        # Set the mirror list
-        self.merge_file_var('/etc/portage/make.conf', 'GENTOO_MIRRORS', mirror_list)
-
-        # Set the core count (this will be overridden by the config MAKEOPTS if supplied)
-        cores = multiprocessing.cpu_count()
-        self.update_file_var('/etc/portage/make.conf', 'MAKEOPTS', '-j%d' % (cores + 1))
-
-        # Get the portage config vars
-        varz = portage.get('vars')
-        for v in varz:
-            if len(v) != 2:
-                raise InstallException('Invalid portage variable')
-            self.update_file_var('/etc/portage/make.conf', v[0], v[1])
-
-        # Set the package specific USE flags
-        packuse = portage.get('packuse')
-        if packuse:
-            [self.set_package_use(n, p, f) for n, p, f in packuse]
-
-        # Set any package accepted keywords
-        packaccept = portage.get('packaccept')
-        if packaccept:
-            [self.set_package_accept(n, p, kw) for n, p, kw in packaccept]
-
-        # Mask any unwanted packages
-        packmask = portage.get('packmask')
-        if packmask:
-            [self.set_package_mask(n, p) for n, p in packmask]
-
-        # Mask any unwanted packages
-        packlic = portage.get('packlicense')
-        if packlic:
-            [self.set_package_license(n, p, f) for n, p, f in packlic]
+        # Apply every make.conf and package.* change with a single write per file
+        with ConfigTransaction() as tx:
+            make_conf = tx.var_file('/etc/portage/make.conf')
+
+            # Set the mirror list
+            make_conf.merge('GENTOO_MIRRORS', mirror_list)
+
+            # Set the core count (this will be overridden by the config MAKEOPTS if supplied)
+            make_conf.set('MAKEOPTS', self.get_makeopts())
+
+            # Get the portage config vars
+            varz = portage.get('vars')
+            for v in varz:
+                if len(v) != 2:
+                    raise InstallException('Invalid portage variable')
+                make_conf.set(v[0], v[1])
+
+            # Build binary packages into the shared cache and reuse any already there
+            binhost = portage.get('binhost')
+            if self.cache.get('binpkgs') or binhost:
+                opts = '--usepkg'
+                make_conf.set('PKGDIR', BINPKG_DIR)
+                if self.cache.get('binpkgs'):
+                    make_conf.merge('FEATURES', 'buildpkg')
+                if binhost:
+                    make_conf.set('PORTAGE_BINHOST', binhost)
+                    opts += ' --getbinpkg'
+                make_conf.merge('EMERGE_DEFAULT_OPTS', opts)
+
+            # Set the package specific USE flags
+            packuse = portage.get('packuse')
+            if packuse:
+                [self.set_package_use(n, p, f, tx=tx) for n, p, f in packuse]
+
+            # Set any package accepted keywords
+            packaccept = portage.get('packaccept')
+            if packaccept:
+                [self.set_package_accept(n, p, kw, tx=tx) for n, p, kw in packaccept]
+
+            # Mask any unwanted packages
+            packmask = portage.get('packmask')
+            if packmask:
+                [self.set_package_mask(n, p, tx=tx) for n, p in packmask]
+
+            # Mask any unwanted packages
+            packlic = portage.get('packlicense')
+            if packlic:
+                [self.set_package_license(n, p, f, tx=tx) for n, p, f in packlic]
 
         # Set system cpu flags if not specified in the config
         if 'cpu_flags_x86' not in [v[0].lower() for v in varz]:
@@ -471,7 +760,7 @@ class GentooInstaller(LinuxInstaller):
 
         self.resync()
         # Update portage itself
-        self.exec_cmd(['emerge', '--oneshot', 'portage'])
+        self.exec_cmd(['emerge', '--oneshot', 'portage'], capture=False)
 
         self.exec_cmd(['emerge', '--info'])
 
@@ -558,7 +847,7 @@ class GentooInstaller(LinuxInstaller):
 
         cl = 'genkernel %s --install initramfs' % (opts)
         cl = cl.split()
-        r, o = self.exec_cmd(cl)
+        r, o = self.exec_cmd(cl, capture=False)
 
     @check_chroot
     def build_kernel(self, kernel={}):
@@ -578,7 +867,7 @@ class GentooInstaller(LinuxInstaller):
         genkernel = kernel.get('genkernel')
         if genkernel:
             # Install genkernel
-            self.exec_cmd(['emerge', '--newuse', '--quiet-build', 'sys-kernel/genkernel'])
+            self.exec_cmd(['emerge', '--newuse', '--quiet-build', 'sys-kernel/genkernel'], capture=False)
             # Genkernel reads the fstab so set it now
             self.format_fstab()
 
@@ -590,13 +879,13 @@ class GentooInstaller(LinuxInstaller):
                 if not opt.startswith('--'):
                     opts[i] = '--%s' % (opt)
             cmd = ['genkernel'] + opts + [action]
-            self.exec_cmd(cmd)
+            self.exec_cmd(cmd, capture=False)
 
         else:
 
             # Get the requested kernel sources
             srcs = kernel.get('sources', 'sys-kernel/gentoo-sources')
-            r, o = self.exec_cmd(['emerge', '--quiet-build', srcs])
+            r, o = self.exec_cmd(['emerge', '--quiet-build', srcs], capture=False)
 
             try:
                 os.chdir('/usr/src/linux')
@@ -618,17 +907,35 @@ class GentooInstaller(LinuxInstaller):
                     self.emerge_package('sys-firmware/sof-firmware', flags=['--quiet-build'])
                     self.emerge_package('net-wireless/wireless-regdb', flags=['--quiet-build'])
 
-            # Compile the kernel
+            # Reuse a kernel built from the same config and sources if there is one
             targets = kernel.get('targets', '')
-            targets = targets.split()
-            cores = multiprocessing.cpu_count()
-            if targets:
-                cmd = ['make'] + targets
-                r, o = self.exec_cmd(cmd)
-            r, o = self.exec_cmd(['make', '-j%d' % (cores + 1)])
+            initramfs = kernel.get('initramfs')
+            entry = None
+            if self.cache.get('kernel'):
+                entry = '%s/%s' % (KERNEL_CACHE_DIR, self.get_kernel_cache_key(srcs, targets, initramfs))
+
+            hit = entry and os.path.isdir(entry)
+            if hit:
+                self.logger.info('Installing cached kernel from %s' % (entry))
+                self.install_cached_kernel(entry)
+            else:
+                boot_files = self.get_boot_files()
+
+                # Build through ccache when caching so a changed config only rebuilds what it touches
+                make = ['make']
+                env = None
+                if entry:
+                    make, env = self.get_ccache_make()
 
-            # Install the kernel
-            r, o = self.exec_cmd(['make', 'install'])
+                # Compile the kernel
+                targets = targets.split()
+                if targets:
+                    cmd = make + targets
+                    r, o = self.exec_cmd(cmd, env=env)
+                r, o = self.exec_cmd(make + ['-j%d' % (self.cores + 1)], env=env, capture=False)
+
+                # Install the kernel
+                r, o = self.exec_cmd(make + ['install'], env=env, capture=False)
 
             # Install modules if necessary
             with open('.config', 'r') as f:
@@ -640,15 +947,19 @@ class GentooInstaller(LinuxInstaller):
                     raise InstallException('Kmod loading disabled but auto modules were set')
 
                 if mods and mods == 'y':
-                    r, o = self.exec_cmd(['make', 'modules_install'])
+                    order = 'modules.order'
+                    if hit:
+                        order = '%s/modules.order' % (entry)
+                    else:
+                        r, o = self.exec_cmd(make + ['modules_install'], env=env, capture=False)
 
                     # Set modules to autoload (if any)
                     built_modules = []
-                    with open('modules.order', 'r') as f:
+                    with open(order, 'r') as f:
                         built_modules = [os.path.splitext(os.path.basename(m))[0] for m in f.readlines()]
 
                     # Validate we built the modules we want to autoload
-                    auto = modules.split()
+                    auto = (modules or '').split()
                     for a in auto:
                         if a not in built_modules:
                             raise InstallException('Module %s was not built, but set to autoload' % (a))
@@ -660,13 +971,90 @@ class GentooInstaller(LinuxInstaller):
                         with open('/etc/modules-load.d/autoload.conf', 'w') as f:
                             f.writelines(['%s\n' % (a) for a in auto])
 
-            # Install a initramfs if needed
-            initramfs = kernel.get('initramfs')
-            if initramfs:
-                self.install_initramfs(initramfs)
+            if not hit:
+                # Install a initramfs if needed
+                if initramfs:
+                    self.install_initramfs(initramfs)
+
+                if entry:
+                    self.store_cached_kernel(entry, boot_files)
+
+    def get_kernel_cache_key(self, srcs, targets, initramfs):
+
+        '''Hash everything that decides the kernel build output (run from the kernel source dir)'''
+
+        sha = hashlib.sha256()
+        with open('.config', 'rb') as f:
+            sha.update(f.read())
+
+        version = os.path.basename(os.path.realpath('.'))
+        for v in (srcs, version, targets, initramfs or ''):
+            sha.update(b'\0' + v.encode('utf-8'))
+        return sha.hexdigest()
+
+    def get_boot_files(self):
+        files = {}
+        for f in os.listdir('/boot'):
+            path = '/boot/%s' % (f)
+            if os.path.isfile(path):
+                files[f] = os.stat(path).st_mtime
+        return files
+
+    def get_ccache_make(self):
+
+        '''Get the make command and environment used to compile through ccache'''
+
+        if not self.which('ccache'):
+            self.emerge_package('dev-util/ccache', flags=['--quiet-build'])
+
+        env = {**os.environ, **{'CCACHE_DIR': '%s/ccache' % (KERNEL_CACHE_DIR)}}
+        return ['make', 'CC=ccache gcc'], env
+
+    def install_cached_kernel(self, entry):
+
+        '''Install a cached kernel image, modules, and initramfs'''
+
+        self.exec_cmd(['tar', 'xpf', '%s/files.tar' % (entry), '-C', '/'], capture=False)
+
+        # Out of tree modules still need a configured and prepared source tree
+        shutil.copyfile('%s/.config' % (entry), '.config')
+        if os.path.exists('%s/Module.symvers' % (entry)):
+            shutil.copyfile('%s/Module.symvers' % (entry), 'Module.symvers')
+        self.exec_cmd(['make', 'modules_prepare'], capture=False)
+
+    def store_cached_kernel(self, entry, boot_files):
+
+        '''Save the files installed by a kernel build to the kernel cache'''
+
+        r, kver = self.exec_cmd(['make', '-s', 'kernelrelease'], quiet=True)
+        kver = kver.strip()
+
+        # Anything new or rewritten in /boot came from this build
+        files = ['boot/%s' % (f) for f, t in self.get_boot_files().items() if boot_files.get(f) != t]
+        if os.path.isdir('/lib/modules/%s' % (kver)):
+            files.append('lib/modules/%s' % (kver))
+
+        tmp = tempfile.mkdtemp(dir=KERNEL_CACHE_DIR)
+        try:
+            self.exec_cmd(['tar', 'cpf', '%s/files.tar' % (tmp), '-C', '/'] + files, capture=False)
+            for f in ('.config', 'modules.order', 'Module.symvers'):
+                if os.path.exists(f):
+                    shutil.copyfile(f, '%s/%s' % (tmp, f))
+            os.rename(tmp, entry)
+            self.logger.info('Stored kernel %s in the cache' % (kver))
+        except OSError:
+            # Another install stored the same kernel first
+            shutil.rmtree(tmp)
 
     @check_chroot
     def auto_unmask(self, output):
+        usename, packuse, flags = self.parse_autounmask(output)
+        self.set_package_use(usename, packuse, flags)
+
+    def parse_autounmask(self, output):
+
+        '''Get the package name, atom and USE flags emerge asks to be set'''
+
         lines = output.splitlines()
         start = None
         end = None
@@ -706,7 +1094,7 @@ class GentooInstaller(LinuxInstaller):
         packuse = data[0]
         flags = ' '.join(data[1:])
 
-        self.set_package_use(usename, packuse, flags)
+        return usename, packuse, flags
 
     @check_chroot
     def format_fstab(self, disks=[], lvms=[]):
@@ -738,33 +1126,91 @@ class GentooInstaller(LinuxInstaller):
 
         return new
 
+    def get_emerge_jobs(self):
+
+        '''Get the number of packages emerge builds at once, only one unless the config asks for more'''
+
+        return max(1, int(self.portage.get('jobs', 1)))
+
+    def get_makeopts(self):
+
+        '''Get the default MAKEOPTS, the cores are split between packages built in parallel'''
+
+        jobs = self.get_emerge_jobs()
+        load = self.portage.get('load_average')
+
+        if jobs > 1:
+            makeopts = '-j%d' % (max(1, self.cores // jobs))
+            load = load or self.cores
+        else:
+            makeopts = '-j%d' % (self.cores + 1)
+
+        if load:
+            makeopts += ' -l%s' % (load)
+        return makeopts
+
+    def get_emerge_job_flags(self):
+
+        '''Get the flags used to build independent packages in parallel (if enabled)'''
+
+        jobs = self.get_emerge_jobs()
+        if jobs == 1:
+            return []
+
+        load = self.portage.get('load_average', self.cores)
+        return ['--jobs=%d' % (jobs), '--load-average=%s' % (load)]
+
+    def get_change_lines(self, input_lines, start_str):
+
+        '''Get the config lines emerge lists after a "The following ... changes" header'''
+
+        out_list = []
+        for i, line in enumerate(input_lines):
+            if start_str in line:
+                for sub_line in input_lines[i:]:
+                    if not len(sub_line):
+                        break
+                    elif sub_line.startswith(('#', '<', '>', '=')):
+                        out_list.append(sub_line)
+        return out_list
+
+    def group_change_lines(self, change_lines):
+
+        '''Split changes up by the package they apply to, keeping their comments'''
+
+        groups = {}
+        comments = []
+        for line in change_lines:
+            if line.startswith('#'):
+                comments.append(line)
+                continue
+            atom = line.split()[0].lstrip('<>=~')
+            groups.setdefault(self.normalize_package_name(atom), []).extend(comments + [line])
+            comments = []
+        return groups
+
     def emerge_package(self, name, flags=[], env={}):
 
+        '''Emerge a package, or a list of packages in a single transaction'''
+
+        names = name
+        if not isinstance(names, list):
+            names = [name]
+
         def _update_portage_file(dir_name, fname, lines):
             portage_base_dir = '/etc/portage/'
 
             target_dir = portage_base_dir + dir_name
             if not os.path.isdir(target_dir):
                 os.mkdir(target_dir)
-            lines = '\n'.join(lines) + '\n'
-            with open('%s/%s' % (target_dir, fname), 'a') as f:
-                f.write(lines)
-
-        def _get_change_lines(input_lines, start_str):
-            out_list = []
-            for i, line in enumerate(input_lines):
-                if start_str in line:
-                    for sub_line in input_lines[i:]:
-                        if not len(sub_line):
-                            break
-                        elif sub_line.startswith(('#', '<', '>', '=')):
-                            out_list.append(sub_line)
-            return out_list
+            f = LineFile('%s/%s' % (target_dir, fname))
+            for line in lines:
+                f.add(line)
+            f.flush()
 
         try:
-            emerge = ['emerge'] + flags
-            emerge.append(name)
-            self.exec_cmd(emerge, env=env, truncate_errors=False)
+            emerge = ['emerge'] + flags + names
+            self.exec_cmd(emerge, env=env, truncate_errors=False, capture=False)
         except CmdError as ce:
 
             if ce.code == errno.EPERM:
@@ -773,14 +1219,13 @@ class GentooInstaller(LinuxInstaller):
                     autounmask = self.portage.get('autounmask', 'interactive').lower()
 
                     if autounmask == 'interactive':
-                        emerge = ['emerge', '--autounmask-write'] + flags
-                        emerge.append(name)
+                        emerge = ['emerge', '--autounmask-write'] + flags + names
                         try:
                             self.exec_cmd(emerge)
                         except CmdError:
                             self.logger.error('Error setting autounmask')
 
-                        emerge = ['emerge', '--quiet-build'] + flags + [name]
+                        emerge = ['emerge', '--quiet-build'] + flags + names
 
                         # Open dispatch-conf to resolve the unmask conflict
                         self.logger.info('Resolving unmask conflict with dispatch-conf')
@@ -788,23 +1233,26 @@ class GentooInstaller(LinuxInstaller):
                     elif autounmask == 'automerge':
 
                         lines = ce.output.splitlines()
-                        pack_name = self.normalize_package_name(name)
+                        pack_name = ' '.join([self.normalize_package_name(n) for n in names])
                         self.logger.info('Automerging unmask conflict for %s' % (pack_name))
 
-                        use_changes = _get_change_lines(lines, 'The following USE changes')
-                        keyword_changes = _get_change_lines(lines, 'The following keyword changes')
-                        license_changes = _get_change_lines(lines, 'The following license changes')
-
-                        if use_changes:
-                            _update_portage_file('package.use', pack_name, use_changes)
-                        if keyword_changes:
-                            _update_portage_file('package.accept_keywords', pack_name, keyword_changes)
-                        if license_changes:
-                            _update_portage_file('package.license', pack_name, license_changes)
-
-                        emerge = ['emerge', '--quiet-build'] + flags
-                        emerge.append(name)
-                    self.exec_cmd(emerge)
+                        changes = (('package.use', 'The following USE changes'),
+                                   ('package.accept_keywords', 'The following keyword changes'),
+                                   ('package.license', 'The following license changes'))
+
+                        for dir_name, header in changes:
+                            change_lines = self.get_change_lines(lines, header)
+                            if not change_lines:
+                                continue
+                            # A batch gets one file per package the changes apply to
+                            if len(names) > 1:
+                                for pname, plines in self.group_change_lines(change_lines).items():
+                                    _update_portage_file(dir_name, pname, plines)
+                            else:
+                                _update_portage_file(dir_name, pack_name, change_lines)
+
+                        emerge = ['emerge', '--quiet-build'] + flags + names
+                    self.exec_cmd(emerge, capture=False)
                 else:
                     raise ce
 
@@ -982,6 +1430,16 @@ class GentooInstaller(LinuxInstaller):
         if not pkgs:
             pkgs = self.packages
 
+        # Resolve and build everything in one emerge run when possible
+        if self.portage.get('batch', True) and len(pkgs) > 1:
+            try:
+                self.emerge_package(list(pkgs), flags=flags + self.get_emerge_job_flags())
+                return
+            except CmdError as ce:
+                if not skip_on_fail:
+                    raise ce
+                self.logger.error('Error installing package batch, error=%s, installing one at a time' % (ce.error))
+
         for pkg in pkgs:
             try:
                 self.emerge_package(pkg, flags=flags)
@@ -1236,18 +1694,64 @@ class GentooInstaller(LinuxInstaller):
 
         verify_retry_count = 40
 
-        # Verify the Portage snapshot here
-        for i in range(verify_retry_count):
-            try:
-                self.exec_cmd(['emerge', '--sync'])
-                break
-            except CmdError as ce:
-                self.logger.info('Sync failed, retrying %d of %d' % (i, verify_retry_count))
-                if ce.code != errno.EPERM:
-                    raise ce
-                _set_profile()
-                if i >= verify_retry_count:
-                    self.logger.error('Failed to verify Portage snapshot')
-                    raise ce
+        def _sync():
+            # Verify the Portage snapshot here
+            for i in range(verify_retry_count):
+                try:
+                    self.exec_cmd(['emerge', '--sync'], capture=False)
+                    break
+                except CmdError as ce:
+                    self.logger.info('Sync failed, retrying %d of %d' % (i, verify_retry_count))
+                    if ce.code != errno.EPERM:
+                        raise ce
+                    _set_profile()
+                    if i >= verify_retry_count:
+                        self.logger.error('Failed to verify Portage snapshot')
+                        raise ce
+
+        if not self.cache.get('repos'):
+            _sync()
+            return
+
+        if self.repos_lock:
+            self.logger.info('Shared portage tree is already synced for this install')
+            return
+
+        # Installs hold a shared lock while they use the tree, syncing needs it exclusively
+        stamp = '%s/.sup-synced' % (REPOS_DIR)
+        lock = open('%s/.sup-sync.lock' % (REPOS_DIR), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            if not self.is_repo_fresh(stamp):
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # Another install may have synced while waiting for the lock
+                if not self.is_repo_fresh(stamp):
+                    _sync()
+                    with open(stamp, 'w') as f:
+                        f.write(self.portage.get('sync_token', ''))
+                fcntl.flock(lock, fcntl.LOCK_SH)
+            else:
+                self.logger.info('Shared portage tree is up to date, skipping sync')
+        except BaseException:
+            lock.close()
+            raise
+
+        # Kept until the install process exits
+        self.repos_lock = lock
+
+    def is_repo_fresh(self, stamp):
+
+        '''Check if a repository shared with other installs is recent enough to skip the sync
+
+        A fleet install syncs once per run (the sync_token), otherwise the
+        tree is fresh for sync_ttl seconds after the last sync.
+        '''
 
+        if not os.path.isdir('%s/gentoo/profiles' % (REPOS_DIR)) or not os.path.exists(stamp):
+            return False
 
+        token = self.portage.get('sync_token')
+        if token:
+            with open(stamp, 'r') as f:
+                return f.read().strip() == token
+        return time.time() - os.path.getmtime(stamp) < self.portage.get('sync_ttl', REPOS_SYNC_TTL)
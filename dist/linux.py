@@ -4,19 +4,81 @@ import time
 import stat
 import shlex
 import errno
-import fcntl
+import select
 import shutil
+import selectors
+import threading
 import subprocess
-import configparser
+import multiprocessing
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 from dist.unix import UnixInstaller, InstallException, CmdError
+from dist.mirrors import MirrorRanker, MIRROR_CACHE_PATH
+from dist.conffile import ConfigTransaction, VarFile, IniFile, LvmFile
 
 FILE_FMT_LVM = 0
 FILE_FMT_VARVAL = 1
 FILE_FMT_INI = 2
 
+# Read size for command output and the amount of it kept for errors when not captured
+CMD_READ_SIZE = 0x10000
+CMD_TAIL_SIZE = 0x100000
+
+# Location of the kernel build cache inside the install target
+KERNEL_CACHE_DIR = '/var/cache/sup/kernel'
+
+# Seconds to wait for udev to create new device nodes
+DEVICE_WAIT_TIMEOUT = 30
+
+
+class MountTable(object):
+
+    '''Cached view of /proc/self/mounts
+
+    The kernel flags the open mounts file with POLLPRI whenever the mount
+    table changes, so it is only re-read after a mount or unmount. The file
+    is reopened when the root changes since paths are relative to the root
+    the process had when it was opened.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.file = None
+        self.root = None
+        self.poller = None
+        self.mounts = set()
+
+    def open(self, root):
+        if self.file:
+            self.file.close()
+
+        self.root = root
+        self.file = open('/proc/self/mounts', 'r')
+        self.poller = select.poll()
+        self.poller.register(self.file, select.POLLPRI | select.POLLERR)
+        self.read()
+
+    def read(self):
+        self.file.seek(0)
+        self.mounts = set()
+        for _l in self.file.readlines():
+            _l = _l.split()
+            if len(_l) > 1:
+                self.mounts.add(_l[1])
+
+    def get(self, root):
+
+        '''Return the mounted paths as seen from root'''
+
+        with self.lock:
+            if self.file is None or root != self.root:
+                self.open(root)
+            elif self.poller.poll(0):
+                self.read()
+            return self.mounts
+
 
 class LinuxInstaller(UnixInstaller):
     '''Generic Linux Installer'''
@@ -28,6 +90,16 @@ class LinuxInstaller(UnixInstaller):
         self.chrooted = False
         self.kconfig = None
 
+        # Timing and resource usage of every command run by exec_cmd, also written
+        # to the event log when one is set. The scheduler names the running phase.
+        self.cmd_stats = []
+        self.events = None
+        self.current_phase = threading.local()
+
+        # Device snapshots, blkid output is dropped whenever the disks change
+        self.block_attrs = None
+        self.mount_table = MountTable()
+
         if kconfig:
             fn = kconfig
             if fn:
@@ -48,6 +120,16 @@ class LinuxInstaller(UnixInstaller):
         self.display = self.config.get('display', {})
         self.services = self.config.get('services', [])
 
+        # Cores used for builds, a fleet install caps this for each target
+        self.cores = self.config.get('cores') or multiprocessing.cpu_count()
+
+        # Ask before erasing the disks, a fleet install confirms them all up front
+        self.confirm_disks = True
+
+        # Optional host side cache directories shared between installs
+        self.cache = self.config.get('cache', {})
+        self.mirror_ranker = MirrorRanker(self.logger, cache_path=self.cache.get('mirrors', MIRROR_CACHE_PATH))
+
         self.init = self.sysconfig.get('init')
 
         # Get network params
@@ -91,11 +173,22 @@ class LinuxInstaller(UnixInstaller):
 
         return None
 
-    def exec_cmd(self, cmd, shell=False, quiet=False, truncate_errors=True, env=None):
+    def exec_cmd(self, cmd, shell=False, quiet=False, truncate_errors=True, env=None,
+                 capture=True, callback=None):
 
-        '''Execute a command/process'''
+        '''Execute a command/process
 
-        output = b''
+        Output is read as soon as the child writes it and is logged line by line,
+        or handed to callback when one is supplied. If capture is False only a
+        bounded tail of the output is kept (for CmdError) and no output is returned.
+        '''
+
+        output = []
+        tail = deque()
+        tail_size = 0
+        peak = 0
+        nbytes = 0
+        partial = b''
 
         lstr = ' '.join(cmd)
         if isinstance(cmd, str):
@@ -103,48 +196,162 @@ class LinuxInstaller(UnixInstaller):
 
         self.logger.info('exec: %s' % (lstr))
 
-        if env:
-            p = subprocess.Popen(cmd, shell=shell, env=env,
-                                 stdin=None,
-                                 stderr=subprocess.STDOUT,
-                                 stdout=subprocess.PIPE)
-        else:
-            p = subprocess.Popen(cmd, shell=shell,
-                                 stdin=None,
-                                 stderr=subprocess.STDOUT,
-                                 stdout=subprocess.PIPE)
+        start = time.time()
+        p = subprocess.Popen(cmd, shell=shell, env=env or None,
+                             stdin=None,
+                             stderr=subprocess.STDOUT,
+                             stdout=subprocess.PIPE)
+
+        def _emit(line):
+            line = line.decode('utf-8', 'ignore').strip()
+            if callback:
+                callback(line)
+            elif not quiet and len(line):
+                self.logger.info(line)
+
+        # Sleep until the child writes something instead of polling the pipe
+        with selectors.DefaultSelector() as sel:
+            sel.register(p.stdout, selectors.EVENT_READ)
+            while True:
+                sel.select()
+                o = os.read(p.stdout.fileno(), CMD_READ_SIZE)
+                if not o:
+                    break
+                nbytes += len(o)
 
-        # Make the pipe non-blocking
-        flags = fcntl.fcntl(p.stdout, fcntl.F_GETFL)
-        flags = flags | os.O_NONBLOCK
-        fcntl.fcntl(p.stdout, fcntl.F_SETFL, flags)
+                if capture:
+                    output.append(o)
+                    peak = nbytes
+                else:
+                    tail.append(o)
+                    tail_size += len(o)
+                    while tail_size - len(tail[0]) >= CMD_TAIL_SIZE:
+                        tail_size -= len(tail.popleft())
+                    peak = max(peak, tail_size)
+
+                lines = (partial + o).split(b'\n')
+                partial = lines.pop()
+                # Don't let output without newlines (progress bars) grow unbounded
+                if len(partial) > CMD_READ_SIZE:
+                    lines.append(partial)
+                    partial = b''
+                # Prompts don't end in a newline, show them once the child has nothing more to say
+                if partial and not sel.select(timeout=0):
+                    lines.append(partial)
+                    partial = b''
+                for line in lines:
+                    _emit(line)
 
-        while (p.poll() is None) or p.stdout.peek():
-            try:
-                o = p.stdout.read()
-                if o and len(o):
-                    if not quiet:
-                        do = o.decode('utf-8', 'ignore').strip()
-                        if len(do):
-                            self.logger.info(do)
-                    output += o
-            except IOError:
-                continue
+        if partial:
+            _emit(partial)
+        p.stdout.close()
+
+        # Reap the child ourselves to get the resources it used
+        pid, status, usage = os.wait4(p.pid, 0)
+        p.returncode = os.waitstatus_to_exitcode(status)
 
         rcode = p.returncode
+        stats = {'cmd': lstr,
+                 'phase': getattr(self.current_phase, 'name', None),
+                 'code': rcode,
+                 'start': start,
+                 'wall': time.time() - start,
+                 'cpu': usage.ru_utime + usage.ru_stime,
+                 'output_bytes': nbytes,
+                 'output_peak': peak}
+        self.cmd_stats.append(stats)
+        if self.events:
+            self.events.emit('cmd', **stats)
+        self.logger.debug('exec done: %s [code=%d wall=%.2fs cpu=%.2fs output=%d bytes]' %
+                          (lstr, rcode, stats['wall'], stats['cpu'], nbytes))
+
+        output = b''.join(output).decode('utf-8', 'ignore')
         if rcode != 0:
             self.logger.error(os.strerror(rcode))
-            errmsg = output.decode('utf-8', 'ignore')
+            errmsg = output
+            if not capture:
+                errmsg = b''.join(tail).decode('utf-8', 'ignore')
             # Truncate long error output
             if truncate_errors:
                 if len(errmsg) > 2000:
                     errmsg = errmsg[-2000:]
             raise CmdError(os.strerror(rcode), rcode, errmsg)
-        return rcode, output.decode('utf-8', 'ignore')
+        return rcode, output
+
+    def get_part_dev(self, disk, pidx):
+
+        '''Get the device node for a partition number on a disk'''
 
-    def prepare_disks(self, disks=[], lvms=[]):
+        if disk.lower().startswith('/dev/nvme'):
+            return '%sp%d' % (disk, pidx,)
+        return '%s%d' % (disk, pidx,)
 
-        '''Format the disks and LVMs if needed'''
+    def wait_for_devices(self, devs, timeout=DEVICE_WAIT_TIMEOUT):
+
+        '''Wait for udev to create the device nodes for newly made partitions and volumes'''
+
+        missing = [d for d in devs if not os.path.exists(d)]
+        if not missing:
+            return
+
+        # Let udev finish processing the queued events, this normally creates every node
+        if self.which('udevadm'):
+            cmd = ['udevadm', 'settle', '--timeout=%d' % (timeout)]
+            if len(missing) == 1:
+                cmd.append('--exit-if-exists=%s' % (missing[0]))
+            try:
+                self.exec_cmd(cmd, quiet=True)
+            except CmdError:
+                pass
+
+        # Fall back to polling with a short backoff for anything udev didn't report
+        delay = 0.05
+        deadline = time.time() + timeout
+        missing = [d for d in missing if not os.path.exists(d)]
+        while missing:
+            if time.time() > deadline:
+                raise InstallException('Timed out waiting for devices: %s' % (', '.join(missing)))
+            self.logger.info('Waiting for devices: %s' % (', '.join(missing)))
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+            missing = [d for d in missing if not os.path.exists(d)]
+
+    def format_devices(self, jobs):
+
+        '''Run format commands concurrently, they each work on a separate device'''
+
+        if not jobs:
+            return
+
+        self.wait_for_devices([cmd[-1] for cmd in jobs])
+        with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            futures = [pool.submit(self.exec_cmd, cmd) for cmd in jobs]
+        [f.result() for f in futures]
+
+    def confirm_disk_overwrite(self, disks=[]):
+
+        '''Have every disk confirmed before it is erased, only asks once per install'''
+
+        if not disks:
+            disks = self.disks
+
+        if not self.confirm_disks:
+            return
+
+        for d in disks:
+            dev_name = input('!!! WARNING: All data on %s will be erased; '
+                             'enter the device name to confirm: ' % d['name'])
+            if dev_name != d['name']:
+                raise Exception('Failed to confirm disk overwrite, exiting')
+        self.confirm_disks = False
+
+    def prepare_disks(self, disks=[], lvms=[], confirm=None):
+
+        '''Format the disks and LVMs if needed
+
+        Partitions and volumes are created first, then the file systems on
+        separate devices are made concurrently.
+        '''
 
         def _get_format_cmd(fs, dev, label=''):
             fs = fs.lower().strip()
@@ -170,17 +377,21 @@ class LinuxInstaller(UnixInstaller):
             disks = self.disks
         if not lvms:
             lvms = self.lvms
+        if confirm is None:
+            confirm = self.confirm_disks
 
         self.logger.info('Preparing disks')
         if not disks:
             return
 
-        for d in disks:
+        # Confirm every disk before touching any of them
+        if confirm:
+            self.confirm_disk_overwrite(disks)
 
-            dev_name = input('!!! WARNING: All data on %s will be erased; '
-                             'enter the device name to confirm: ' % d['name'])
-            if dev_name != d['name']:
-                raise Exception('Failed to confirm disk overwrite, exiting')
+        # Partition the disks, parted has to run one at a time on a disk
+        formats = []
+        crypts = []
+        for d in disks:
 
             if d.get('label'):
                 try:
@@ -194,10 +405,7 @@ class LinuxInstaller(UnixInstaller):
                               'mkpart', p['type'], p['start'], p['end']])
 
                 pidx = i + 1
-                if d['name'].lower().startswith('/dev/nvme'):
-                    part = '%sp%d' % (d['name'], pidx,)
-                else:
-                    part = '%s%d' % (d['name'], pidx,)
+                part = self.get_part_dev(d['name'], pidx)
                 pidx = str(pidx)
 
                 n = p.get('name')
@@ -210,48 +418,36 @@ class LinuxInstaller(UnixInstaller):
 
                 fs = p.get('fs')
                 if fs:
-                    cmd = _get_format_cmd(fs, part)
-                    self.exec_cmd(cmd)
+                    formats.append(_get_format_cmd(fs, part))
 
                 c = p.get('crypt')
                 if c:
-                    self.exec_cmd(['modprobe', 'dm-crypt', 'aes', 'sha256'])
-
-                    for i in range(10):
-                        try:
-                            self.exec_cmd(['cryptsetup', '--batch-mode', 'luksFormat', part])
-                            break
-                        except CmdError as err:
-                            if err.code == errno.EINTR:
-                                self.logger.info('cryptsetup partition not found, trying again...')
-                                time.sleep(1)
-                                continue
-                            elif err.code != errno.EIO:
-                                raise err
-                            else:
-                                break
-
-                    if c.get('mapping'):
-                        self.exec_cmd(['cryptsetup', 'open', '--type', 'luks',
-                                       part, c['mapping']])
+                    crypts.append((part, c))
+
+        self.format_devices(formats)
+
+        # cryptsetup asks for the passphrase so these have to be done one by one
+        if crypts:
+            self.exec_cmd(['modprobe', 'dm-crypt', 'aes', 'sha256'])
+            self.wait_for_devices([part for part, c in crypts])
 
+        for part, c in crypts:
+            try:
+                self.exec_cmd(['cryptsetup', '--batch-mode', 'luksFormat', part])
+            except CmdError as err:
+                if err.code != errno.EIO:
+                    raise err
+
+            if c.get('mapping'):
+                self.exec_cmd(['cryptsetup', 'open', '--type', 'luks',
+                               part, c['mapping']])
+
+        formats = []
         for lvm in lvms:
 
             pv = lvm['physvol']
-            # Looks like there can be a slight race here with partitions
-            # not being found after creating physical partitions,
-            # try multiple times with a 10 try timeout
-            for i in range(10):
-                try:
-                    self.exec_cmd(['pvcreate', '-ff', pv])
-                    break
-                except CmdError as err:
-                    if err.code != errno.EIO:
-                        raise err
-                    else:
-                        self.logger.info('pvcreate partition not found, trying again...')
-                        time.sleep(1)
-                        continue
+            self.wait_for_devices([pv])
+            self.exec_cmd(['pvcreate', '-ff', pv])
 
             for g in lvm['volgroups']:
                 gname = g['name']
@@ -263,15 +459,33 @@ class LinuxInstaller(UnixInstaller):
 
                     fs = vol.get('fs')
                     if fs:
-                        cmd = _get_format_cmd(fs, '/dev/%s/%s' % (gname, vol['name']), label=vol.get('label'))
-                        self.exec_cmd(cmd)
+                        formats.append(_get_format_cmd(fs, '/dev/%s/%s' % (gname, vol['name']),
+                                                       label=vol.get('label')))
+
+        self.format_devices(formats)
+
+        # The block ids all changed
+        self.block_attrs = None
 
-    def get_block_attrs(self):
+    def get_block_attrs(self, refresh=False):
 
-        '''Get block device attributes used for the fstab'''
+        '''Get block device attributes used for the fstab
+
+        blkid is only run once, the result is kept until the disks are prepared again.
+        '''
+
+        if self.block_attrs is not None and not refresh:
+            return self.block_attrs
 
         r, o = self.exec_cmd(['blkid'], quiet=True)
-        output = o.split('\n')
+        self.block_attrs = self.parse_blkid(o)
+        return self.block_attrs
+
+    def parse_blkid(self, output):
+
+        '''Parse blkid output into a dict of attributes for each device'''
+
+        output = output.split('\n')
         pat = (r"(?P<dev>\S*(?=:))",
                r"(?P<uuid>(?<=UUID=\")\S*(?=\"))",
                r"(?P<type>(?<=TYPE=\")\S*(?=\"))",
@@ -436,61 +650,30 @@ class LinuxInstaller(UnixInstaller):
 
         '''Merge variables with a file'''
 
-        val = self.get_file_var(fname, var)
-        if not val:
-            self.update_file_var(fname, var, new)
-            return
-
-        ovals = val.split(' ')
-        nvals = new.split(' ')
-
-        merge = set(ovals + nvals)
-        merge = ' '.join(merge)
-
-        self.update_file_var(fname, var, merge)
+        f = VarFile(fname)
+        f.merge(var, new)
+        f.flush()
 
     def get_file_var(self, fname, var):
 
         '''Get variable contents from a file'''
 
-        with open(fname, 'r') as f:
-            lines = f.readlines()
-            return self.get_var_val(var, lines)
+        return VarFile(fname).get(var)
 
     def update_file_var(self, fname, var, value, use_quotes=True):
 
         '''Set variable in a file'''
 
-        mode = 'w+'
-        if os.path.exists(fname):
-            mode = 'r+'
-
-        kv = '%s=\"%s\"\n' % (var, value)
-        if not use_quotes:
-            kv = '%s=%s\n' % (var, value)
-
-        with open(fname, mode) as f:
-            lines = f.readlines()
-            i = self.get_var_line(var, lines)
-            if i is None:
-                lines.append(kv)
-            else:
-                lines[i] = kv
-            f.seek(0)
-            f.writelines(lines)
-            f.truncate()
+        f = VarFile(fname)
+        f.set(var, value, use_quotes=use_quotes)
+        f.flush()
 
     def is_mounted(self, path):
 
         '''Check if a given directory path is currently mounted'''
 
-        with open('/proc/mounts', 'r') as m:
-            lines = m.readlines()
-            for _l in lines:
-                _l = _l.split()
-                if len(_l) > 1 and (_l[1] == path or _l[1] == path.rstrip('/')):
-                    return True
-        return False
+        mounts = self.mount_table.get(self.chrooted)
+        return path in mounts or path.rstrip('/') in mounts
 
     def get_parts_by_attr(self, attr, val=None):
 
@@ -638,6 +821,16 @@ class LinuxInstaller(UnixInstaller):
 
             self.mount_single_device(mnt, dev)
 
+    def mount_cache_dir(self, cache_dir, target):
+
+        '''Bind mount a host cache directory onto a path in the install target'''
+
+        path = self.mount_point + target
+        os.makedirs(cache_dir, exist_ok=True)
+        os.makedirs(path, exist_ok=True)
+        if not self.is_mounted(path):
+            self.exec_cmd(['mount', '--bind', cache_dir, path])
+
     def mount_rootfs(self):
 
         '''Mount the root file system'''
@@ -670,80 +863,70 @@ class LinuxInstaller(UnixInstaller):
 
         '''Modify INI style files (commonly used in systemd)'''
 
-        mode = 'w'
+        f = IniFile(path, strict=strict)
+        f.update(fields, merge=merge)
+        f.flush()
 
-        cfg = configparser.ConfigParser(strict=strict)
-        cfg.optionxform = str
-        cfg.read(path)
+    def read_xorg_conf(self, path):
+        with open(path, 'r') as f:
+            return self.parse_xorg_conf(f.readlines(), path)
 
-        if merge:
-            for k, v in fields.items():
-                if cfg.has_section(k):
-                    for z, x in v.items():
-                        cfg.set(k, str(z), str(x))
-                else:
-                    cfg.update(fields)
-        else:
-            cfg.update(fields)
+    def parse_xorg_conf(self, lines, path=''):
 
-        with open(path, mode) as f:
-            cfg.write(f)
+        '''Parse the lines of an Xorg config into a dict of sections'''
 
-    def read_xorg_conf(self, path):
         out_dict = OrderedDict()
         in_sect = False
         sect = None
         subsect = None
         in_subsect = False
-        with open(path, 'r') as f:
-            lines = f.readlines()
-
-            for i, line in enumerate(lines):
-
-                # Look for section header
-                fields = shlex.split(line)
-                vals = line.split('\"')[1::2]
-                opts = [o for o in fields if o not in vals]
-                if len(opts) > 1:
-                    vals = []
-                    copt = None
-                    for f in fields[1:]:
-                        if f in opts:
-                            copt = f
-                            vals.append(OrderedDict({copt: []}))
-                        elif not copt:
-                            vals.append(f)
-                        else:
-                            [v[copt].append(f) for v in vals if isinstance(v, dict)]
-
-                if fields:
-                    typ = fields[0].strip()
-                    if not in_sect and typ == 'Section':
-                        if len(fields) != 2:
-                            raise InstallException('Invalid Xorg config: %s' % (path))
-                        sect = fields[1].strip('\"')
-                        out_dict.update(OrderedDict({sect: OrderedDict()}))
-                        in_sect = True
-
-                    elif typ == 'EndSection':
-                        in_sect = False
-
-                    elif in_sect and not in_subsect and typ == 'SubSection':
-                        if len(fields) != 2:
-                            raise InstallException('Invalid Xorg config: %s' % (path))
-                        subsect = fields[1].strip('\"')
-                        out_dict[sect].update(OrderedDict({subsect: {}}))
-                        in_subsect = True
-
-                    elif typ == 'EndSubSection':
-                        in_subsect = False
-
-                    elif in_subsect and len(fields) > 1:
-                        opt = fields[0]
-                        out_dict[sect][subsect].update(OrderedDict({opt: vals}))
-                    elif in_sect and len(fields) > 1:
-                        opt = fields[0]
-                        out_dict[sect].update(OrderedDict({opt: vals}))
+
+        for i, line in enumerate(lines):
+
+            # Look for section header
+            fields = shlex.split(line)
+            vals = line.split('\"')[1::2]
+            opts = [o for o in fields if o not in vals]
+            if len(opts) > 1:
+                vals = []
+                copt = None
+                for f in fields[1:]:
+                    if f in opts:
+                        copt = f
+                        vals.append(OrderedDict({copt: []}))
+                    elif not copt:
+                        vals.append(f)
+                    else:
+                        [v[copt].append(f) for v in vals if isinstance(v, dict)]
+
+            if fields:
+                typ = fields[0].strip()
+                if not in_sect and typ == 'Section':
+                    if len(fields) != 2:
+                        raise InstallException('Invalid Xorg config: %s' % (path))
+                    sect = fields[1].strip('\"')
+                    out_dict.update(OrderedDict({sect: OrderedDict()}))
+                    in_sect = True
+
+                elif typ == 'EndSection':
+                    in_sect = False
+
+                elif in_sect and not in_subsect and typ == 'SubSection':
+                    if len(fields) != 2:
+                        raise InstallException('Invalid Xorg config: %s' % (path))
+                    subsect = fields[1].strip('\"')
+                    out_dict[sect].update(OrderedDict({subsect: {}}))
+                    in_subsect = True
+
+                elif typ == 'EndSubSection':
+                    in_subsect = False
+
+                elif in_subsect and len(fields) > 1:
+                    opt = fields[0]
+                    out_dict[sect][subsect].update(OrderedDict({opt: vals}))
+                elif in_sect and len(fields) > 1:
+                    opt = fields[0]
+                    out_dict[sect].update(OrderedDict({opt: vals}))
         return (out_dict)
 
     def _set_xorg_conf_section(self, path, conf):
@@ -841,15 +1024,19 @@ class LinuxInstaller(UnixInstaller):
 
     @check_chroot
     def do_misc_config(self):
-        for cfg in self.misc_config:
-            path = cfg.get('path')
-            if not path:
-                raise InstallException('No path supplied for config file')
-            sects = cfg.get('sections', {})
-            for sect in sects:
-                name = sect.get('name')
-                for var, val in sect.get('values', []):
-                    self.misc_config(path, var, val, name)
+
+        '''Apply the misc config values, writing each file once'''
+
+        with ConfigTransaction() as tx:
+            for cfg in self.misc_config:
+                path = cfg.get('path')
+                if not path:
+                    raise InstallException('No path supplied for config file')
+                sects = cfg.get('sections', {})
+                for sect in sects:
+                    name = sect.get('name')
+                    for var, val in sect.get('values', []):
+                        self.set_config_value(tx, path, var, val, name)
 
     def get_file_format(self, path):
 
@@ -892,45 +1079,29 @@ class LinuxInstaller(UnixInstaller):
 
         raise InstallException('Unknown file format for %s' % (path))
 
-    @check_chroot
-    def misc_config(self, path, var, val, section=''):
-        def _set_lvm_vars(path, var, val, section=''):
-            with open(path, 'r+') as f:
-                lines = f.readlines()
-                curr_sect = ''
-                for i, l in enumerate(lines):
-                    hit = re.search('[a-z ]+(?={)', l)
-                    if hit and not l.strip().startswith('#'):
-
-                        curr_sect = hit.group(0).strip()
-                    if section and curr_sect == section:
-                        if var in l and not l.strip().startswith('#'):
-                            splt = l.split('=')
-                            splt[1] = str(val) + '\n'
-                            lines[i] = '= '.join(splt)
-                            break
-
-                    if not l.strip().startswith('#') and l.strip().startswith('}'):
-                        if section and curr_sect == section:
-                            lines.insert(i, '\t' + ' = '.join([str(var), str(val)]))
-                            break
-
-                f.seek(0)
-                f.writelines(lines)
-                f.truncate()
-
-        def _set_ini_vars(path, var, val, section=''):
-            if not section:
-                raise InstallException('Need a section name to update an INI file')
-            self.update_ini_file(path, {section: {var: val}}, merge=True)
+    def set_config_value(self, tx, path, var, val, section=''):
 
-        def _set_var_val(path, var, val, section=''):
-            self.update_file_var(path, var, val)
+        '''Set a value in a config file of any supported format as part of a transaction'''
+
+        if path not in tx.files:
+            fmt = self.get_file_format(path)
+        elif isinstance(tx.files[path], LvmFile):
+            fmt = FILE_FMT_LVM
+        elif isinstance(tx.files[path], IniFile):
+            fmt = FILE_FMT_INI
+        else:
+            fmt = FILE_FMT_VARVAL
 
-        fmt = self.get_file_format(path)
         if fmt == FILE_FMT_LVM:
-            _set_lvm_vars(path, var, val, section)
+            tx.lvm_file(path).set(var, val, section)
         elif fmt == FILE_FMT_INI:
-            _set_ini_vars(path, var, val, section)
+            if not section:
+                raise InstallException('Need a section name to update an INI file')
+            tx.ini_file(path).update({section: {var: val}}, merge=True)
         elif fmt == FILE_FMT_VARVAL:
-            _set_var_val(path, var, val, section)
+            tx.var_file(path).set(var, val)
+
+    @check_chroot
+    def misc_config(self, path, var, val, section=''):
+        with ConfigTransaction() as tx:
+            self.set_config_value(tx, path, var, val, section)
@@ -0,0 +1,152 @@
+import os
+import ssl
+import json
+import time
+import socket
+import hashlib
+import tempfile
+import threading
+import contextlib
+import urllib.request
+
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+from dist.unix import lock_file
+
+# How long a ranking stays valid and how much of the probe file is downloaded
+MIRROR_CACHE_TTL = 86400
+MIRROR_SAMPLE_SIZE = 0x40000
+
+# Host side location of the ranking cache when the config doesn't set one
+MIRROR_CACHE_PATH = '/var/cache/sup/mirrors.json'
+
+DEFAULT_PORTS = {'http': 80, 'https': 443, 'ftp': 21, 'rsync': 873}
+
+
+class MirrorRanker(object):
+
+    '''Ranks mirrors by connect latency and the time taken to fetch a short sample
+
+    Every candidate is probed concurrently. Rankings are kept in memory and,
+    when cache_path is set, in a JSON file so later installs can reuse them
+    until they are older than the requested TTL. Installs sharing the file
+    take turns ranking, so only the first one probes the mirrors.
+    '''
+
+    def __init__(self, logger, cache_path=None, timeout=5, workers=16):
+        self.logger = logger
+        self.cache_path = cache_path
+        self.timeout = timeout
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.rankings = {}
+
+        if cache_path:
+            self.cache_path = os.path.abspath(cache_path)
+
+    def load(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+
+        try:
+            with open(self.cache_path, 'r') as f:
+                self.rankings.update(json.load(f))
+        except ValueError:
+            self.logger.error('Ignoring invalid mirror cache: %s' % (self.cache_path))
+
+    def save(self):
+        if not self.cache_path:
+            return
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.cache_path), prefix='.mirrors.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.rankings, f, indent=4)
+            os.replace(tmp, self.cache_path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def cache_lock(self):
+
+        '''Lock the cache file against other installs while ranking'''
+
+        if not self.cache_path:
+            return contextlib.nullcontext()
+
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        return lock_file('%s.lock' % (self.cache_path))
+
+    def probe(self, url, path=''):
+
+        '''Return the estimated seconds needed to fetch the sample from a mirror, or None if it failed'''
+
+        u = urlparse(url)
+        port = u.port or DEFAULT_PORTS.get(u.scheme)
+        if not u.hostname or not port:
+            return None
+
+        try:
+            start = time.time()
+            with socket.create_connection((u.hostname, port), timeout=self.timeout):
+                latency = time.time() - start
+        except OSError:
+            return None
+
+        # Only latency can be measured without speaking the protocol
+        if u.scheme not in ('http', 'https'):
+            return latency
+
+        req = urllib.request.Request(url.rstrip('/') + '/' + path.lstrip('/'))
+        req.add_header('Range', 'bytes=0-%d' % (MIRROR_SAMPLE_SIZE - 1))
+        try:
+            start = time.time()
+            with urllib.request.urlopen(req, timeout=self.timeout,
+                                        context=ssl._create_unverified_context()) as r:
+                nbytes = len(r.read(MIRROR_SAMPLE_SIZE))
+            elapsed = max(time.time() - start, 1e-6)
+        except (OSError, ValueError):
+            return None
+
+        if not nbytes:
+            return None
+        return latency + MIRROR_SAMPLE_SIZE / (nbytes / elapsed)
+
+    def rank(self, urls, path='', ttl=MIRROR_CACHE_TTL, key=None):
+
+        '''Return the reachable mirrors in urls, fastest first
+
+        urls can be a function returning the candidates when getting them is
+        costly, it is only called when there is no cached ranking. The ranking
+        is cached under key, or the candidates themselves if no key is given.
+        '''
+
+        if key is None:
+            key = '\n'.join(sorted(urls))
+        key = hashlib.sha256(('%s\n%s' % (path, key)).encode('utf-8')).hexdigest()
+
+        # Hold the locks while probing so other installs wait for this ranking instead of probing too
+        with self.lock, self.cache_lock():
+            self.load()
+            cached = self.rankings.get(key)
+            if cached and time.time() - cached['time'] < ttl:
+                self.logger.info('Using cached mirror ranking from %s' % (time.ctime(cached['time'])))
+                return cached['mirrors']
+
+            if callable(urls):
+                urls = urls()
+            self.logger.info('Ranking %d mirrors' % (len(urls)))
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                scores = list(pool.map(lambda u: self.probe(u, path), urls))
+
+            ranked = sorted([(s, u) for s, u in zip(scores, urls) if s is not None])
+            for s, u in ranked:
+                self.logger.debug('Mirror %s: %.3fs' % (u, s))
+            ranked = [u for s, u in ranked]
+
+            # Don't remember a ranking where nothing answered (e.g. the network was down)
+            if ranked:
+                self.rankings[key] = {'time': time.time(), 'mirrors': ranked}
+                self.save()
+            return ranked
@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from dist.unix import InstallException
+from dist.events import get_report
+
+# Journal of finished phases, kept on the install target
+JOURNAL_PATH = '/var/lib/sup/phases.json'
+
+
+class Phase(object):
+
+    '''A named install step made of installer methods
+
+    deps names the phases that have to finish first. Phases that never enter
+    the chroot (chroot=False) and are marked background run on a worker
+    thread while the installer carries on with other host side phases.
+    confirm is called before any phase of the run starts, so prompts aren't
+    mixed up with the output of background phases. Phases marked rerun set up
+    state that doesn't survive a reboot (mounts) and run again on every resume.
+    '''
+
+    def __init__(self, name, funcs, deps=[], flag=None, chroot=True, background=False, confirm=None,
+                 rerun=False):
+        self.name = name
+        self.funcs = funcs
+        self.deps = deps
+        self.flag = flag or name
+        self.chroot = chroot
+        self.background = background
+        self.confirm = confirm
+        self.rerun = rerun
+
+        if background and chroot:
+            raise InstallException('Background phase %s can not use the chroot' % (name))
+
+
+class PhaseScheduler(object):
+
+    '''Runs install phases in dependency order and journals the ones that finish'''
+
+    def __init__(self, inst, phases, config):
+        self.inst = inst
+        self.logger = inst.logger
+        self.phases = phases
+        self.lock = threading.Lock()
+        self.phase_stats = []
+
+        with open(config, 'rb') as f:
+            self.config_sha = hashlib.sha256(f.read()).hexdigest()
+
+        self.journal = {'config': self.config_sha, 'phases': {}}
+
+    def get_journal_path(self):
+        if self.inst.chrooted:
+            return JOURNAL_PATH
+        # Don't write into the mount point directory until the target root is on it
+        if not self.inst.is_mounted(self.inst.mount_point):
+            return None
+        return self.inst.mount_point + JOURNAL_PATH
+
+    def load_journal(self, force=False):
+
+        '''Read the journal left on the target by a previous run
+
+        A journal written with a different install config is refused unless
+        force is set, the finished phases may not match the new config.
+        '''
+
+        if not self.inst.chrooted:
+            try:
+                self.inst.mount_rootfs()
+            except InstallException:
+                # The previous run stopped before the root file system was made
+                self.logger.info('Unable to mount the root file system, nothing to resume')
+                return
+
+        path = self.get_journal_path()
+        if not path or not os.path.exists(path):
+            self.logger.info('No phase journal found, nothing to resume')
+            return
+
+        with open(path, 'r') as f:
+            journal = json.load(f)
+
+        if journal.get('config') != self.config_sha:
+            if not force:
+                raise InstallException('Install config changed since the journaled run, '
+                                       'run without resuming or force the resume')
+            self.logger.error('Install config changed since the journaled run, resuming anyway')
+
+        self.journal['phases'].update(journal.get('phases', {}))
+
+    def save_journal(self):
+        path = self.get_journal_path()
+        if not path:
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.tmp' % (path)
+        with open(tmp, 'w') as f:
+            json.dump(self.journal, f, indent=4)
+        os.replace(tmp, path)
+
+    def is_done(self, name):
+        return name in self.journal['phases']
+
+    def run_phase(self, phase):
+        self.logger.info('Starting phase: %s' % (phase.name))
+        start = time.time()
+        cpu = time.thread_time()
+        status = 'failed'
+
+        # Commands run from this thread are attributed to the phase
+        self.inst.current_phase.name = phase.name
+        try:
+            for func in phase.funcs:
+                func()
+            status = 'finished'
+        finally:
+            self.inst.current_phase.name = None
+            duration = time.time() - start
+            self.add_phase_stats(phase, status, start, duration, time.thread_time() - cpu)
+
+        self.logger.info('Finished phase: %s (%.1fs)' % (phase.name, duration))
+
+        with self.lock:
+            self.journal['phases'][phase.name] = {'finished': time.time(), 'duration': duration}
+            self.save_journal()
+
+    def add_phase_stats(self, phase, status, start, duration, python_cpu):
+        stats = {'phase': phase.name,
+                 'status': status,
+                 'start': start,
+                 'wall': duration,
+                 'python_cpu': python_cpu,
+                 'cmd_cpu': sum([c['cpu'] for c in self.inst.cmd_stats if c.get('phase') == phase.name])}
+        with self.lock:
+            self.phase_stats.append(stats)
+        if self.inst.events:
+            self.inst.events.emit('phase', **stats)
+
+    def report(self):
+
+        '''Log the slowest phases and commands of the run'''
+
+        if not self.phase_stats and not self.inst.cmd_stats:
+            return
+        [self.logger.info(line) for line in get_report(self.phase_stats, self.inst.cmd_stats)]
+
+    def run(self, names, resume=False, force=False):
+
+        '''Run the named phases, skipping journaled ones if resuming
+
+        Dependencies only order the selected phases, they are not added
+        to the run. A dependency that was not selected counts as satisfied.
+        Rerun phases a previous run finished are always run when resuming.
+        '''
+
+        if resume:
+            self.load_journal(force=force)
+
+        pending = []
+        for p in self.phases:
+            if resume and p.rerun and self.is_done(p.name):
+                self.logger.info('Running finished phase again: %s' % (p.name))
+                pending.append(p)
+                continue
+            if p.name not in names:
+                continue
+            if resume and self.is_done(p.name):
+                self.logger.info('Skipping finished phase: %s' % (p.name))
+                continue
+            pending.append(p)
+
+        # Ask for any confirmation before background phases start writing to the terminal
+        [p.confirm() for p in pending if p.confirm]
+
+        try:
+            self.schedule(pending)
+        finally:
+            self.report()
+
+    def schedule(self, pending):
+
+        '''Run the pending phases, starting background phases on worker threads'''
+
+        running = {}
+
+        def _ready(phase):
+            busy = [p.name for p in pending] + list(running.values())
+            return not [d for d in phase.deps if d in busy]
+
+        with ThreadPoolExecutor() as pool:
+            while pending or running:
+
+                # Start every background phase that can run now
+                if not self.inst.chrooted:
+                    for p in [p for p in pending if p.background and _ready(p)]:
+                        pending.remove(p)
+                        running[pool.submit(self.run_phase, p)] = p.name
+
+                # Run the next foreground phase, chroot phases have to wait for the background ones
+                nxt = None
+                for p in pending:
+                    if not _ready(p):
+                        continue
+                    if p.background or not p.chroot or not running:
+                        nxt = p
+                        break
+
+                if nxt:
+                    pending.remove(nxt)
+                    self.run_phase(nxt)
+                    continue
+
+                if not running:
+                    raise InstallException('Unable to schedule phases: %s' % (', '.join([p.name for p in pending])))
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in done:
+                    running.pop(f)
+                    f.result()
@@ -1,6 +1,8 @@
 import os
 import json
+import fcntl
 import logging
+import contextlib
 
 
 # Disable logger exceptions
@@ -38,6 +40,19 @@ def get_logger(logpath):
     return logger
 
 
+@contextlib.contextmanager
+def lock_file(path):
+
+    '''Hold an exclusive lock on a file shared with other installs'''
+
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 class UnixInstaller(object):
     '''Generic Unix-like installer'''
 
@@ -1,6 +1,8 @@
 import argparse
 
 from dist.arch import ArchInstaller
+from dist.phases import PhaseScheduler
+from dist.events import EventLog
 
 
 def parse_args(parser):
@@ -15,46 +17,21 @@ def parse_args(parser):
 
     inst = ArchInstaller(cfg, kconfig=kfg, logpath=log)
 
-    tasks = [args.prepdisks, args.setupenv, args.kernel, args.fstab, args.packages, args.pacstrap,
-             args.services, args.bootloader, args.network, args.users, args.dm, args.all]
-    if not any(tasks):
-        parser.print_help()
-        return
-
-    if args.all or args.prepdisks:
-        inst.prepare_disks()
-
-    if args.all or args.pacstrap:
-        inst.pacstrap()
-
-    if args.all or args.setupenv:
-        inst.setup_environment()
-        inst.config_system_info()
-
-    if args.all or args.kernel:
-        inst.build_kernel()
+    if args.events:
+        inst.events = EventLog(args.events)
 
-    if args.all or args.fstab:
-        inst.format_fstab()
+    phases = inst.get_phases()
+    names = [p.name for p in phases if args.all or getattr(args, p.flag)]
 
-    if args.all or args.packages:
-        inst.get_misc_packages()
-        inst.remove_misc_packages()
+    # Resuming without any phases picks up the full install where it stopped
+    if args.resume and not names:
+        names = [p.name for p in phases]
 
-    if args.all or args.services:
-        inst.install_services()
-
-    if args.all or args.dm:
-        inst.config_display_manager()
-
-    if args.all or args.bootloader:
-        inst.config_boot_loader()
-
-    if args.all or args.network:
-        inst.config_network()
+    if not names:
+        parser.print_help()
+        return
 
-    if args.all or args.users:
-        inst.setup_users()
+    PhaseScheduler(inst, phases, cfg).run(names, resume=args.resume, force=args.force_resume)
 
 
 if __name__ == '__main__':
@@ -66,6 +43,12 @@ if __name__ == '__main__':
     parser.add_argument('-a, --all', action='store_true', dest='all', help='Performs a full Arch install')
     parser.add_argument('-k', '--kconfig', action='store', dest='kconfig', required=False,
                         help='Optional path to kconfig file used for the kernel build')
+    parser.add_argument('-r', '--resume', action='store_true', dest='resume',
+                        help='Skips phases the journal on the install target marks as finished')
+    parser.add_argument('--force-resume', action='store_true', dest='force_resume',
+                        help='Resumes even if the install config changed since the journaled run')
+    parser.add_argument('-e', '--events', action='store', dest='events', required=False,
+                        help='Path to a file the phase and command timings are written to as JSON lines')
 
     parser.add_argument('--prepdisks', action='store_true', help='Formats disks, partitions, and LVMs')
     parser.add_argument('--pacstrap', action='store_true', help='Configures and installs pacman')
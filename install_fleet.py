@@ -0,0 +1,67 @@
+import json
+import argparse
+
+from dist.arch import ArchInstaller
+from dist.gentoo import GentooInstaller
+from dist.fleet import Fleet, FleetJob
+
+INSTALLERS = {'gentoo': GentooInstaller, 'arch': ArchInstaller}
+
+
+def parse_args(parser):
+
+    args = parser.parse_args()
+
+    log = args.logpath
+    if not log:
+        log = 'sup_fleet.log'
+
+    with open(args.fleet_file, 'r') as f:
+        fleet = json.load(f)
+
+    jobs = [FleetJob(j['name'], j['config'], j['mount_point'], kconfig=j.get('kconfig'),
+                     devices=j.get('devices', {}), logpath=j.get('logpath')) for j in fleet['jobs']]
+
+    # Phase names don't depend on the config, any of the targets can list them
+    installer = INSTALLERS[args.distro]
+    inst = installer(jobs[0].config, logpath=log)
+    names = [p.name for p in inst.get_phases()]
+    if args.phases:
+        names = [n for n in names if n in args.phases.split(',')]
+
+    cache = args.cache_dir or fleet.get('cache', '/var/cache/sup')
+    max_jobs = args.max_jobs or fleet.get('max_jobs')
+    cores = args.cores or fleet.get('cores')
+
+    fl = Fleet(installer, jobs, cache, workdir=args.workdir, max_jobs=max_jobs, cores=cores, events=args.events)
+
+    failed = fl.run(names, resume=args.resume)
+    if failed:
+        inst.logger.error('Failed installs: %s' % (', '.join(failed)))
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Install several targets at once from a fleet file')
+    parser.add_argument('-f', '--file', action='store', dest='fleet_file', required=True,
+                        help='Path to the fleet file listing the install jobs')
+    parser.add_argument('-d', '--distro', action='store', dest='distro', choices=sorted(INSTALLERS),
+                        default='gentoo', help='Distribution installed on every target (default is gentoo)')
+    parser.add_argument('-l', '--logpath', action='store', dest='logpath', required=False,
+                        help='Path to the fleet log file, each target logs to its own file')
+    parser.add_argument('-C', '--cache', action='store', dest='cache_dir', required=False,
+                        help='Cache directory shared by all targets (default is /var/cache/sup)')
+    parser.add_argument('-w', '--workdir', action='store', dest='workdir', default='fleet',
+                        help='Directory the generated install config of each target is written to')
+    parser.add_argument('-j', '--jobs', action='store', dest='max_jobs', type=int, required=False,
+                        help='Maximum number of targets installed at the same time')
+    parser.add_argument('-n', '--cores', action='store', dest='cores', type=int, required=False,
+                        help='Host cores split between the running installs (default is all of them)')
+    parser.add_argument('-p', '--phases', action='store', dest='phases', required=False,
+                        help='Comma separated install phases to run (default is a full install)')
+    parser.add_argument('-r', '--resume', action='store_true', dest='resume',
+                        help='Skips phases the journal on each install target marks as finished')
+    parser.add_argument('-e', '--events', action='store_true', dest='events',
+                        help='Writes the phase and command timings of each target to the work directory as JSON lines')
+
+    parse_args(parser)
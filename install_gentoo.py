@@ -1,6 +1,8 @@
 import argparse
 
 from dist.gentoo import GentooInstaller
+from dist.phases import PhaseScheduler
+from dist.events import EventLog
 
 
 def parse_args(parser):
@@ -19,58 +21,21 @@ def parse_args(parser):
 
     inst = GentooInstaller(cfg, mount_point=mp, kconfig=kfg, logpath=log, no_chroot=args.no_chroot)
 
-    tasks = [args.prepdisks, args.getstage, args.setupenv, args.sysconf, args.config_portage,
-             args.update_world, args.kernel, args.fstab, args.packages, args.services,
-             args.bootloader, args.network, args.users, args.misc_config, args.display, args.all]
-    if not any(tasks):
-        parser.print_help()
-        return
-
-    if args.all or args.prepdisks:
-        inst.prepare_disks()
-        inst.mount_rootfs()
-
-    if args.all or args.getstage:
-        inst.get_stage()
-
-    if args.all or args.setupenv:
-        inst.setup_environment()
-
-    if args.all or args.config_portage:
-        inst.config_portage()
-
-    if args.all or args.sysconf:
-        inst.config_system_info()
-
-    if args.all or args.update_world:
-        inst.update_world_set()
+    if args.events:
+        inst.events = EventLog(args.events)
 
-    if args.all or args.kernel:
-        inst.build_kernel()
+    phases = inst.get_phases()
+    names = [p.name for p in phases if args.all or getattr(args, p.flag)]
 
-    if args.all or args.fstab:
-        inst.format_fstab()
+    # Resuming without any phases picks up the full install where it stopped
+    if args.resume and not names:
+        names = [p.name for p in phases]
 
-    if args.all or args.packages:
-        inst.get_misc_packages()
-
-    if args.all or args.network:
-        inst.config_network()
-
-    if args.all or args.services:
-        inst.install_services()
-
-    if args.all or args.bootloader:
-        inst.config_boot_loader()
-
-    if args.all or args.misc_config:
-        inst.do_misc_config()
-
-    if args.all or args.display:
-        inst.config_display()
+    if not names:
+        parser.print_help()
+        return
 
-    if args.all or args.users:
-        inst.setup_users()
+    PhaseScheduler(inst, phases, cfg).run(names, resume=args.resume, force=args.force_resume)
 
 
 if __name__ == '__main__':
@@ -86,6 +51,12 @@ if __name__ == '__main__':
                         help='Optional path to kconfig file used for the kernel build')
     parser.add_argument('-m', '--mount', action='store', dest='mount_point', required=False,
                         help='Specifies the mount point for the install (default is /mnt/gentoo)')
+    parser.add_argument('-r', '--resume', action='store_true', dest='resume',
+                        help='Skips phases the journal on the install target marks as finished')
+    parser.add_argument('--force-resume', action='store_true', dest='force_resume',
+                        help='Resumes even if the install config changed since the journaled run')
+    parser.add_argument('-e', '--events', action='store', dest='events', required=False,
+                        help='Path to a file the phase and command timings are written to as JSON lines')
 
     parser.add_argument('--prepdisks', action='store_true', help='Formats disks, partitions, and LVMs')
     parser.add_argument('--getstage', action='store_true', help='Downloads the install stage from gentoo.org')
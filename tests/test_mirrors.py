@@ -0,0 +1,110 @@
+import os
+import time
+import socket
+import logging
+import tempfile
+import threading
+import unittest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dist.mirrors import MirrorRanker
+
+SAMPLE = b'x' * 0x10000
+
+
+def start_mirror(delay=0):
+
+    '''Start a local HTTP server standing in for a mirror, returns the server and its URL'''
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(SAMPLE)))
+            self.end_headers()
+            self.wfile.write(SAMPLE)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d/mirror' % (server.server_address[1])
+
+
+def get_closed_url():
+
+    '''Get the URL of a local port nothing is listening on'''
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    return 'http://127.0.0.1:%d/mirror' % (port)
+
+
+class MirrorRankerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.tmp.name, 'mirrors.json')
+        self.servers = []
+
+    def tearDown(self):
+        for s in self.servers:
+            s.shutdown()
+            s.server_close()
+        self.tmp.cleanup()
+
+    def get_ranker(self):
+        return MirrorRanker(logging.getLogger('test'), cache_path=self.cache_path, timeout=2)
+
+    def mirror(self, delay=0):
+        server, url = start_mirror(delay)
+        self.servers.append(server)
+        return url
+
+    def test_fastest_first(self):
+        slow = self.mirror(delay=0.3)
+        fast = self.mirror()
+        self.assertEqual(self.get_ranker().rank([slow, fast], path='probe'), [fast, slow])
+
+    def test_drops_unreachable(self):
+        fast = self.mirror()
+        self.assertEqual(self.get_ranker().rank([get_closed_url(), fast]), [fast])
+
+    def test_reuses_cached_ranking(self):
+        urls = [self.mirror(), self.mirror(delay=0.1)]
+        ranked = self.get_ranker().rank(urls)
+
+        # A fresh ranker (a later install) reads the cache and doesn't ask for the candidates
+        def _fail():
+            raise AssertionError('Candidates fetched despite a cached ranking')
+
+        self.assertEqual(self.get_ranker().rank(_fail, key='\n'.join(sorted(urls))), ranked)
+
+    def test_expired_ranking_is_redone(self):
+        urls = [self.mirror()]
+        self.get_ranker().rank(urls, key='config')
+
+        calls = []
+
+        def _get_candidates():
+            calls.append(True)
+            return urls
+
+        self.get_ranker().rank(_get_candidates, key='config', ttl=0)
+        self.assertEqual(len(calls), 1)
+
+    def test_empty_ranking_not_cached(self):
+        urls = [get_closed_url()]
+        self.assertEqual(self.get_ranker().rank(urls), [])
+        self.assertFalse(os.path.exists(self.cache_path))
+
+        # Once a mirror answers it is ranked rather than the empty result being reused
+        fast = self.mirror()
+        self.assertEqual(self.get_ranker().rank(lambda: urls + [fast], key='\n'.join(sorted(urls))), [fast])
+
+
+if __name__ == '__main__':
+    unittest.main()
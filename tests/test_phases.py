@@ -0,0 +1,154 @@
+import os
+import time
+import logging
+import tempfile
+import threading
+import unittest
+
+from dist.unix import InstallException
+from dist.phases import Phase, PhaseScheduler, JOURNAL_PATH
+
+
+class FakeInstaller(object):
+
+    '''Stands in for an installer, the target root is a temporary directory'''
+
+    def __init__(self, mount_point, rootfs=True):
+        self.logger = logging.getLogger('test')
+        self.mount_point = mount_point
+        self.rootfs = rootfs
+        self.chrooted = False
+        self.cmd_stats = []
+        self.events = None
+        self.current_phase = threading.local()
+
+    def is_mounted(self, path):
+        return self.rootfs and path == self.mount_point
+
+    def mount_rootfs(self):
+        if not self.rootfs:
+            raise InstallException('Unable to mount the root file system')
+
+
+class PhaseSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.mount_point = os.path.join(self.tmp.name, 'mnt')
+        os.makedirs(self.mount_point)
+        self.config = os.path.join(self.tmp.name, 'install.cfg')
+        self.write_config('{}')
+
+        self.lock = threading.Lock()
+        self.events = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_config(self, data):
+        with open(self.config, 'w') as f:
+            f.write(data)
+
+    def step(self, name, delay=0, fail=False):
+
+        '''Get a phase function recording when it starts and ends'''
+
+        def _step():
+            with self.lock:
+                self.events.append(('start', name))
+            time.sleep(delay)
+            if fail:
+                raise InstallException('%s failed' % (name))
+            with self.lock:
+                self.events.append(('end', name))
+        return _step
+
+    def run_phases(self, phases, names=None, resume=False, force=False, inst=None):
+        inst = inst or FakeInstaller(self.mount_point)
+        names = names or [p.name for p in phases]
+        PhaseScheduler(inst, phases, self.config).run(names, resume=resume, force=force)
+
+    def started(self):
+        return [n for e, n in self.events if e == 'start']
+
+    def test_dependency_order(self):
+        phases = [Phase('c', [self.step('c')], deps=['b']),
+                  Phase('b', [self.step('b')], deps=['a']),
+                  Phase('a', [self.step('a')])]
+        self.run_phases(phases)
+        self.assertEqual(self.started(), ['a', 'b', 'c'])
+
+    def test_unselected_dependency_is_satisfied(self):
+        phases = [Phase('a', [self.step('a')]),
+                  Phase('b', [self.step('b')], deps=['a'])]
+        self.run_phases(phases, names=['b'])
+        self.assertEqual(self.started(), ['b'])
+
+    def test_chroot_phase_waits_for_background(self):
+        phases = [Phase('fetch', [self.step('fetch', delay=0.2)], chroot=False, background=True),
+                  Phase('host', [self.step('host')], chroot=False),
+                  Phase('chroot', [self.step('chroot')])]
+        self.run_phases(phases)
+
+        # Host side phases overlap the background phase, chroot phases start after it
+        self.assertLess(self.events.index(('end', 'host')), self.events.index(('end', 'fetch')))
+        self.assertLess(self.events.index(('end', 'fetch')), self.events.index(('start', 'chroot')))
+
+    def test_background_phase_failure_is_raised(self):
+        phases = [Phase('fetch', [self.step('fetch', fail=True)], chroot=False, background=True),
+                  Phase('chroot', [self.step('chroot')])]
+        with self.assertRaises(InstallException):
+            self.run_phases(phases)
+        self.assertNotIn('chroot', self.started())
+
+    def test_resume_skips_journaled_phases(self):
+        phases = [Phase('a', [self.step('a')]),
+                  Phase('b', [self.step('b', fail=True)], deps=['a'])]
+        with self.assertRaises(InstallException):
+            self.run_phases(phases)
+        self.assertTrue(os.path.exists(self.mount_point + JOURNAL_PATH))
+
+        self.events = []
+        phases = [Phase('a', [self.step('a')]),
+                  Phase('b', [self.step('b')], deps=['a'])]
+        self.run_phases(phases, resume=True)
+        self.assertEqual(self.started(), ['b'])
+
+    def test_resume_reruns_environment_phases(self):
+        phases = [Phase('env', [self.step('env')], chroot=False, rerun=True),
+                  Phase('a', [self.step('a')], deps=['env'])]
+        self.run_phases(phases)
+
+        self.events = []
+        self.run_phases(phases, names=['a'], resume=True)
+        self.assertEqual(self.started(), ['env'])
+
+    def test_resume_without_rootfs(self):
+        phases = [Phase('a', [self.step('a')])]
+        self.run_phases(phases, resume=True, inst=FakeInstaller(self.mount_point, rootfs=False))
+        self.assertEqual(self.started(), ['a'])
+
+    def test_resume_refuses_changed_config(self):
+        phases = [Phase('a', [self.step('a')]),
+                  Phase('b', [self.step('b')])]
+        self.run_phases(phases)
+
+        self.write_config('{"hostname": "changed"}')
+        self.events = []
+        with self.assertRaises(InstallException):
+            self.run_phases(phases, resume=True)
+        self.assertEqual(self.started(), [])
+
+        self.run_phases(phases, resume=True, force=True)
+        self.assertEqual(self.started(), [])
+
+    def test_unable_to_schedule(self):
+        phases = [Phase('a', [self.step('a')], deps=['b']),
+                  Phase('b', [self.step('b')], deps=['a'])]
+        with self.assertRaisesRegex(InstallException, 'Unable to schedule phases: a, b'):
+            self.run_phases(phases)
+        self.assertEqual(self.started(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()